@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+'''
+    Script to benchmark the python overhead of Hamamatsu camera capture
+    paths. Runs against the simulated DCAM library by default, so it works
+    without a camera.
+'''
+
+# System imports
+import os
+import argparse
+import time
+
+# Scientific computing
+import numpy as np
+
+
+def create_parser():
+    '''
+        Create parser for benchmark settings.
+
+        Outputs:
+            args: Namespace object with benchmark settings
+    '''
+    parser = argparse.ArgumentParser(description='Camera capture benchmark')
+
+    parser.add_argument('-f', '--fps', action='store', type=float,
+                        default=100, help='Simulated frame rate')
+    parser.add_argument('-s', '--size', action='store', type=int, nargs=2,
+                        default=[1024, 1024], help='ROI size (H W)')
+    parser.add_argument('-b', '--binning', action='store', type=int,
+                        default=1, help='Binning (1, 2 or 4)')
+    parser.add_argument('-d', '--droprate', action='store', type=float,
+                        default=0, help='Probability of a dropped frame')
+    parser.add_argument('-n', '--nframes', action='store', type=int,
+                        default=200, help='Number of frames per test')
+    parser.add_argument('--hardware', action='store_true',
+                        help='Use the real camera instead of the simulation')
+
+    return parser.parse_args()
+
+def report(name, nframes, total_time, dropped=0):
+    '''
+        Print frame rate of a test.
+    '''
+    print('%-24s %6d frames in %6.3fs = %8.1f fps, %d dropped'%(
+        name, nframes, total_time, nframes/total_time, dropped))
+
+def run_test(name, nframes, func):
+    '''
+        Time a test, which returns the number of dropped frames.
+        A ring buffer overrun means the capture path is slower than the
+        camera, which is reported instead of stopping the benchmark.
+    '''
+    tic = time.perf_counter()
+    try:
+        dropped = func()
+    except RuntimeError as err:
+        print('%-24s %s'%(name, err))
+        return
+
+    report(name, nframes, time.perf_counter() - tic, dropped)
+
+def capture_test(camera, nframes, accumulator=None):
+    '''
+        Average frames from the ring buffer.
+    '''
+    camera.capture(nframes, accumulator)
+
+    return 0
+
+def burst_test(camera, frames):
+    '''
+        Capture a burst into a preallocated array.
+    '''
+    camera.capture_burst(frames.shape[0], frames)
+
+    return 0
+
+def stream_test(camera, nframes):
+    '''
+        Stream with a consumer that only releases buffers.
+    '''
+    stream = camera.start_stream(queue_depth=8)
+    try:
+        for idx in range(nframes):
+            stream.release(stream.get(timeout=5))
+    finally:
+        camera.stop_stream()
+
+    return stream.dropped
+
+if __name__ == '__main__':
+    args = create_parser()
+
+    # Simulation has to be selected before dcamapi is imported
+    if not args.hardware:
+        os.environ['DCAM_SIMULATE'] = '1'
+        os.environ['DCAM_SIM_FPS'] = str(args.fps)
+        os.environ['DCAM_SIM_SENSOR'] = '%dx%d'%tuple(args.size)
+        os.environ['DCAM_SIM_DROPRATE'] = str(args.droprate)
+
+    from modules import hardware
+    from modules import utils
+
+    nframes = args.nframes
+    camera = hardware.HCamera(0, exposure_time=0.1, binning=args.binning,
+                              roi_size=args.size, fast=True, bufsize=64)
+    print('Frame size: %dx%d'%tuple(camera.size))
+
+    # Averaging from the ring buffer
+    run_test('capture(navg)', nframes,
+             lambda: capture_test(camera, nframes))
+
+    # Running statistics
+    accumulator = utils.FrameAccumulator('welford')
+    run_test('capture(welford)', nframes,
+             lambda: capture_test(camera, nframes, accumulator))
+
+    # Burst into a preallocated array
+    frames = np.zeros([nframes] + camera.size, dtype=np.uint16)
+    run_test('capture_burst', nframes, lambda: burst_test(camera, frames))
+
+    # Streaming with a consumer that only releases buffers
+    run_test('stream', nframes, lambda: stream_test(camera, nframes))
+
+    camera.close()
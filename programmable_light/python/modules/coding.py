@@ -97,6 +97,73 @@ def bincode(H, W, col=True):
 
     return codes
 
+def pack_bitplanes(codes, bits_per_channel=8):
+    '''
+        Pack binary codes as bit planes of RGB frames.
+
+        Inputs:
+            codes: H x W x ncodes binary codes, such as the output of bincode
+                or hadamard_code
+            bits_per_channel: 8 (default) packs 24 codes per frame, code k
+                going to bit k%8 of channel (k//8)%3, for SLMs that show the
+                bit planes of a frame in sequence. 1 packs 3 codes per frame,
+                one per channel with values 0 or 255, for channel masking.
+
+        Outputs:
+            frames: H x W x 3 x nframes uint8 frames
+    '''
+    if bits_per_channel not in [1, 8]:
+        raise ValueError('bits_per_channel must be 1 or 8')
+
+    [H, W, ncodes] = codes.shape
+    nplanes = 3*bits_per_channel
+    nframes = int(np.ceil(ncodes/nplanes))
+
+    frames = np.zeros((H, W, 3, nframes), dtype=np.uint8)
+
+    for idx in range(ncodes):
+        [frame, plane] = divmod(idx, nplanes)
+        [channel, bit] = divmod(plane, bits_per_channel)
+
+        if bits_per_channel == 1:
+            value = 255
+        else:
+            value = 1 << bit
+
+        frames[:, :, channel, frame][codes[:, :, idx] > 0] |= value
+
+    return frames
+
+def unpack_bitplanes(frames, ncodes, bits_per_channel=8):
+    '''
+        Recover binary codes from frames packed with pack_bitplanes.
+
+        Inputs:
+            frames: H x W x 3 x nframes uint8 frames
+            ncodes: Number of packed codes
+            bits_per_channel: 8 or 1, same as used for packing
+
+        Outputs:
+            codes: H x W x ncodes binary codes
+    '''
+    [H, W, _, _] = frames.shape
+    nplanes = 3*bits_per_channel
+
+    codes = np.zeros((H, W, ncodes))
+
+    for idx in range(ncodes):
+        [frame, plane] = divmod(idx, nplanes)
+        [channel, bit] = divmod(plane, bits_per_channel)
+
+        if bits_per_channel == 1:
+            value = 255
+        else:
+            value = 1 << bit
+
+        codes[:, :, idx] = (frames[:, :, channel, frame] & value) > 0
+
+    return codes
+
 def bindecode(data, ref):
     '''
         Decode binary coded data to get correspondences
@@ -4,6 +4,7 @@
 module for accessing DCAM via DCAM-API.
 """
 
+import os
 import platform
 from enum import IntEnum
 import ctypes
@@ -14,7 +15,12 @@ from ctypes import *
 
 # ==== load shared library ====
 
-__dll = cdll.LoadLibrary('dcamapi')
+# With DCAM_SIMULATE=1, a simulated library is created after the declarations
+# below. See dcamsim.py
+if os.environ.get('DCAM_SIMULATE', '0') == '0':
+	__dll = cdll.LoadLibrary('dcamapi')
+else:
+	__dll = None
 
 # ==== declare constants ====
 
@@ -1338,110 +1344,165 @@ class DCAMREC_STATUS(Structure):
 		self.size = sizeof(DCAMREC_STATUS)
 
 
+# ==== simulated library ====
+
+if __dll is None:
+	from modules import dcamsim
+	__dll = dcamsim.from_environment()
+
+
+# ==== declare function signatures ====
+# Signatures are bound once, so calls below can pass handles and structures
+# as they are, without building c_void_p and byref objects on every call.
+
+def __bind(name, argtypes, restype=c_int32):
+	if not isinstance(__dll, CDLL) or not hasattr(__dll, name):
+		return
+	func = getattr(__dll, name)
+	func.argtypes = argtypes
+	func.restype = restype
+
+__bind('dcamapi_init', [POINTER(DCAMAPI_INIT)])
+__bind('dcamapi_uninit', [])
+__bind('dcamdev_open', [POINTER(DCAMDEV_OPEN)])
+__bind('dcamdev_close', [c_void_p])
+__bind('dcamdev_getstring', [c_void_p, POINTER(DCAMDEV_STRING)])
+__bind('dcamwait_open', [POINTER(DCAMWAIT_OPEN)])
+__bind('dcamwait_close', [c_void_p])
+__bind('dcamwait_start', [c_void_p, POINTER(DCAMWAIT_START)])
+__bind('dcamwait_abort', [c_void_p])
+__bind('dcambuf_alloc', [c_void_p, c_int32])
+__bind('dcambuf_release', [c_void_p, c_int32])
+__bind('dcambuf_lockframe', [c_void_p, POINTER(DCAMBUF_FRAME)])
+__bind('dcamcap_start', [c_void_p, c_int32])
+__bind('dcamcap_stop', [c_void_p])
+__bind('dcamcap_record', [c_void_p, c_void_p])
+__bind('dcamcap_transferinfo', [c_void_p, POINTER(DCAMCAP_TRANSFERINFO)])
+__bind('dcamcap_firetrigger', [c_void_p, c_int32])
+__bind('dcamprop_getattr', [c_void_p, POINTER(DCAMPROP_ATTR)])
+__bind('dcamprop_getvalue', [c_void_p, c_int32, POINTER(c_double)])
+__bind('dcamprop_setvalue', [c_void_p, c_int32, c_double])
+__bind('dcamprop_setgetvalue', [c_void_p, c_int32, POINTER(c_double), c_int32])
+__bind('dcamprop_queryvalue', [c_void_p, c_int32, POINTER(c_double), c_int32])
+__bind('dcamprop_getnextid', [c_void_p, POINTER(c_int32), c_int32])
+__bind('dcamprop_getname', [c_void_p, c_int32, c_char_p, c_int32])
+__bind('dcamprop_getvaluetext', [c_void_p, POINTER(DCAMPROP_VALUETEXT)])
+__bind('dcamrec_openA', [POINTER(DCAMREC_OPEN)])
+__bind('dcamrec_close', [c_void_p])
+__bind('dcamrec_status', [c_void_p, POINTER(DCAMREC_STATUS)])
+
+
 # ==== assign aliases ====
 
 def init(initparam):
-	return __dll.dcamapi_init(byref(initparam))
+	return __dll.dcamapi_init(initparam)
 
 def uninit():
 	return __dll.dcamapi_uninit()
 
 def open(openparam):
-	return __dll.dcamdev_open(byref(openparam))
+	return __dll.dcamdev_open(openparam)
 
 def close(hdcam):
-	return __dll.dcamdev_close(ctypes.c_void_p(hdcam))
+	return __dll.dcamdev_close(hdcam)
 
 def getcapability(hdcam, capparam):
 	return __dll.dcamdev_getcapability(ctypes.c_void_p(hdcam), byref(capparam))
 
 def getstring(hdcam, stringparam):
-	return __dll.dcamdev_getstring(ctypes.c_void_p(hdcam), byref(stringparam))
+	return __dll.dcamdev_getstring(hdcam, stringparam)
 
 def waitopen(waitopenparam):
-	return __dll.dcamwait_open(byref(waitopenparam))
+	return __dll.dcamwait_open(waitopenparam)
 
 def waitclose(hwait):
-	return __dll.dcamwait_close(ctypes.c_void_p(hwait))
+	return __dll.dcamwait_close(hwait)
 
 def waitstart(hdcam, waitstartparam):
-	return __dll.dcamwait_start(ctypes.c_void_p(hdcam), byref(waitstartparam))
+	return __dll.dcamwait_start(hdcam, waitstartparam)
 
 def waitabort(hwait):
-	return __dll.dcamwait_abort(ctypes.c_void_p(hwait))
+	return __dll.dcamwait_abort(hwait)
 
 def alloc(hdcam, frames):
-	return __dll.dcambuf_alloc(ctypes.c_void_p(hdcam), frames)
+	return __dll.dcambuf_alloc(hdcam, frames)
 
 def release(hdcam):
-	return __dll.dcambuf_release(ctypes.c_void_p(hdcam))
+	return __dll.dcambuf_release(hdcam, 0)
 
 def startcapture(hdcam, mode):
-	return __dll.dcamcap_start(ctypes.c_void_p(hdcam), mode)
+	return __dll.dcamcap_start(hdcam, mode)
 
 def stopcapture(hdcam):
-	return __dll.dcamcap_stop(ctypes.c_void_p(hdcam))
+	return __dll.dcamcap_stop(hdcam)
 
 def startrecorder(hdcam, hrec):
-	return __dll.dcamcap_record(ctypes.c_void_p(hdcam), ctypes.c_void_p(hrec))
+	return __dll.dcamcap_record(hdcam, hrec)
 
 def gettransferinfo(hdcam, transferparam):
-	return __dll.dcamcap_transferinfo(ctypes.c_void_p(hdcam), byref(transferparam))
+	return __dll.dcamcap_transferinfo(hdcam, transferparam)
 
 def lockframe(hdcam, frame):
-	return __dll.dcambuf_lockframe(ctypes.c_void_p(hdcam), byref(frame))
+	return __dll.dcambuf_lockframe(hdcam, frame)
 
 def getpropattr(hdcam, propattrparam):
-	retval = __dll.dcamprop_getattr(ctypes.c_void_p(hdcam), byref(propattrparam))
+	retval = __dll.dcamprop_getattr(hdcam, propattrparam)
 	# return retval
 	# does not return successful for some reason
 	return DCERR.SUCCESS
 
 def getpropvalue(hdcam, propid):
 	cval = ctypes.c_double(0)
-	retval = __dll.dcamprop_getvalue(ctypes.c_void_p(hdcam), propid, byref(cval))
+	retval = __dll.dcamprop_getvalue(hdcam, propid, cval)
 	if retval != DCERR.SUCCESS:
 		return None
 	return cval.value
 
 def setpropvalue(hdcam, propid, value):
-	return __dll.dcamprop_setvalue(ctypes.c_void_p(hdcam), propid, ctypes.c_double(value))
+	return __dll.dcamprop_setvalue(hdcam, propid, value)
+
+def setgetpropvalue(hdcam, propid, value, option=0):
+	cval = ctypes.c_double(value)
+	retval = __dll.dcamprop_setgetvalue(hdcam, propid, cval, option)
+	if retval != DCERR.SUCCESS:
+		return None
+	return cval.value
 
 def querypropvalue(hdcam, propid, value, option):
 	cval = ctypes.c_double(value)
-	retval = __dll.dcamprop_queryvalue(ctypes.c_void_p(hdcam), propid, byref(cval), option)
+	retval = __dll.dcamprop_queryvalue(hdcam, propid, cval, option)
 	if retval != DCERR.SUCCESS:
 		return None
 	return cval.value
 
 def getnextpropid(hdcam, propid, option):
 	func = ctypes.c_int32(propid)
-	retval = __dll.dcamprop_getnextid(ctypes.c_void_p(hdcam), byref(func), option)
+	retval = __dll.dcamprop_getnextid(hdcam, func, option)
 	if retval != DCERR.SUCCESS:
 		return 0
 	return int(func.value)
 
 def getpropname(hdcam, propid, text, textbytes):
-	retval = __dll.dcamprop_getname(ctypes.c_void_p(hdcam), propid, text, textbytes)
+	retval = __dll.dcamprop_getname(hdcam, propid, text, textbytes)
 	if retval != DCERR.SUCCESS:
 		return None
 	return text.decode()
 
 def getvaluetext(hdcam, valuetextparam):
-	return __dll.dcamprop_getvaluetext(ctypes.c_void_p(hdcam), byref(valuetextparam))
+	return __dll.dcamprop_getvaluetext(hdcam, valuetextparam)
 
 def openrec(recopenparam):
-	return __dll.dcamrec_openA(byref(recopenparam))
+	return __dll.dcamrec_openA(recopenparam)
 
 def closerec(hrec):
-	return __dll.dcamrec_close(ctypes.c_void_p(hrec))
+	return __dll.dcamrec_close(hrec)
 
 def lockframerec(hrec):
 	return __dll.dcamrec_lockframe(ctypes.c_void_p(hrec))
 
 def getrecorderstatus(hrec, recstatusparam):
-	return __dll.dcamrec_status(ctypes.c_void_p(hrec), byref(recstatusparam))
+	return __dll.dcamrec_status(hrec, recstatusparam)
 
 # NOTE: Implemented by Vishwanath Saragadam on 7th Nov 2019
 def firetrigger(hdcam):
-        return __dll.dcamcap_firetrigger(ctypes.c_void_p(hdcam), 0)
+        return __dll.dcamcap_firetrigger(hdcam, 0)
@@ -4,6 +4,15 @@ from ctypes import Structure, POINTER, sizeof, byref
 import numpy
 from modules import dcamapi
 
+# Wraps DCAM frame memory in a memoryview without copying
+_buffrommem = ctypes.pythonapi.PyMemoryView_FromMemory
+_buffrommem.argtypes = [c_void_p, ctypes.c_ssize_t, ctypes.c_int]
+_buffrommem.restype = ctypes.py_object
+
+# DCAM error codes as returned by the library, which are signed 32 bit
+ERR_TIMEOUT = c_int32(dcamapi.DCERR.TIMEOUT).value
+ERR_ABORT = c_int32(dcamapi.DCERR.ABORT).value
+
 def init():
         initparam = dcamapi.DCAMAPI_INIT()
         retval = dcamapi.init(initparam)
@@ -35,6 +44,64 @@ class Property(Structure):
                 ("value_text_value",    POINTER(c_double*16)),
         ]
 
+# Properties that change the frame size, and need the buffer to be reallocated
+_SUBARRAY_PROPS = (dcamapi.DCAMIDPROP.SUBARRAYHPOS, dcamapi.DCAMIDPROP.SUBARRAYHSIZE,
+                   dcamapi.DCAMIDPROP.SUBARRAYVPOS, dcamapi.DCAMIDPROP.SUBARRAYVSIZE)
+_RESIZE_PROPS = _SUBARRAY_PROPS + (dcamapi.DCAMIDPROP.SUBARRAYMODE,
+                                   dcamapi.DCAMIDPROP.BINNING)
+
+class FrameInfo:
+        def __init__(self):
+                """
+                Metadata of a frame, filled in by getframe, getframe_into and
+                lockframe when passed as info. timestamp is the hardware time
+                of the frame in seconds, framestamp counts frames exposed by
+                the camera since capture started, so a gap means a lost frame.
+                """
+                self.frameindex = -1
+                self.timestamp = 0.0
+                self.framestamp = 0
+                self.camerastamp = 0
+
+        def __repr__(self):
+                return 'FrameInfo(frameindex={}, timestamp={}, framestamp={})'.format(
+                        self.frameindex, self.timestamp, self.framestamp)
+
+        def update(self, frameparam):
+                self.frameindex = frameparam.iFrame
+                self.timestamp = frameparam.timestamp.sec + frameparam.timestamp.microsec*1e-6
+                self.framestamp = frameparam.framestamp
+                self.camerastamp = frameparam.camerastamp
+
+class LockedFrame:
+        def __init__(self, camera, view):
+                """
+                Zero-copy view of a frame in the DCAM buffer. self.view is a
+                (height, width) uint16 memoryview that is released, and so
+                can no longer be read, when release() is called. self.array
+                is a numpy array over the same memory for convenience; numpy
+                arrays cannot be revoked, so it and any array made from the
+                view must not be used after release(). Used as a context
+                manager it returns self.view.
+                """
+                self._camera = camera
+                self.view = view
+                self.array = numpy.asarray(view)
+
+        def __enter__(self):
+                return self.view
+
+        def __exit__(self, exc_type, exc_value, traceback):
+                self.release()
+
+        def release(self):
+                self.array = None
+                if self.view is not None:
+                        self.view.release()
+                        self.view = None
+                if self._camera._lockedframe is self:
+                        self._camera._lockedframe = None
+
 class Camera:
         def __init__(self, index=-1):
                 """
@@ -52,6 +119,16 @@ class Camera:
                 self._bCapturing = False
                 self._nAllocatedFrames = 0
                 self._mCaptureMode = 1
+                self._lockedframe = None
+                self._propcache = {}            #propid: (requested value, effective value)
+                self.waiterror = 0              #error code of the last failed waitforframe()
+
+                # Parameter structures reused by every call in the capture loop.
+                # A Camera should be used from one thread at a time.
+                self._waitstartparam = dcamapi.DCAMWAIT_START()
+                self._waitstartparam.eventmask = dcamapi.WAIT_EVENT.CAP_FRAMEREADY
+                self._transferparam = dcamapi.DCAMCAP_TRANSFERINFO()
+                self._frameparam = dcamapi.DCAMBUF_FRAME()
                 return
 
         def __repr__(self):
@@ -66,7 +143,7 @@ class Camera:
                 if self._bAlloc == False:
                         print('Buffer not allocated')
                         return 0
-                transferparam = dcamapi.DCAMCAP_TRANSFERINFO()
+                transferparam = self._transferparam
                 retval = dcamapi.gettransferinfo(self._hdcam, transferparam)
                 if retval != dcamapi.DCERR.SUCCESS:
                         print('No success')
@@ -167,42 +244,103 @@ class Camera:
                 return True
         
         def getcapturecount(self):
-                transferparam = dcamapi.DCAMCAP_TRANSFERINFO()
+                transferparam = self._transferparam
                 retval = dcamapi.gettransferinfo(self._hdcam, transferparam)
                 if retval != dcamapi.DCERR.SUCCESS:
                         return 0
                 return transferparam.nFrameCount
         
         def getcaptureindex(self):
-                transferparam = dcamapi.DCAMCAP_TRANSFERINFO()
+                transferparam = self._transferparam
                 retval = dcamapi.gettransferinfo(self._hdcam, transferparam)
                 if retval != dcamapi.DCERR.SUCCESS:
                         return 0
                 return transferparam.nNewestFrameIndex
 
         def waitforframe(self, timeout):
-                waitstartparam = dcamapi.DCAMWAIT_START()
-                waitstartparam.eventmask = dcamapi.WAIT_EVENT.CAP_FRAMEREADY
+                """
+                Wait up to timeout ms for the next frame. On failure the
+                error code is kept in self.waiterror. Timeouts and aborts
+                are not printed, since callers may keep waiting or have
+                aborted the wait on purpose.
+                """
+                waitstartparam = self._waitstartparam
                 waitstartparam.timeout = timeout
                 retval = dcamapi.waitstart(self._hwait, waitstartparam)
                 if retval != dcamapi.DCERR.SUCCESS:
-                        print("ERROR: waitforframe()", retval)
+                        self.waiterror = retval
+                        if retval not in (ERR_TIMEOUT, ERR_ABORT):
+                                print("ERROR: waitforframe()", retval)
                         return False
                 return True
         
-        def getframe(self, frameindex):
-                frameparam = dcamapi.DCAMBUF_FRAME()
+        def abortwait(self):
+                """
+                Abort a waitforframe() call that is blocked in another thread.
+                """
+                if self._bOpenedwait == False:
+                        return False
+                retval = dcamapi.waitabort(self._hwait)
+                if retval != dcamapi.DCERR.SUCCESS:
+                        return False
+                return True
+
+        def _lockview(self, frameindex, info):
+                frameparam = self._frameparam
                 frameparam.iFrame = frameindex
                 retval = dcamapi.lockframe(self._hdcam, frameparam)
                 if retval != dcamapi.DCERR.SUCCESS:
                         print('Could not lock frame')
                         return None
-                data_pointer = ctypes.cast(frameparam.buf, ctypes.POINTER(ctypes.c_int))
-                buffrommem = ctypes.pythonapi.PyMemoryView_FromMemory
-                buffrommem.restype = ctypes.py_object
-                buffer = buffrommem(data_pointer, frameparam.width*frameparam.height*2, 0x100)
-                data_array = numpy.frombuffer(buffer, dtype=numpy.uint16)
-                return numpy.reshape(data_array, (-1, frameparam.width))
+                if info is not None:
+                        info.update(frameparam)
+                buffer = _buffrommem(frameparam.buf, frameparam.width*frameparam.height*2, 0x100)
+                return buffer.cast('H', (frameparam.height, frameparam.width))
+
+        def getframe(self, frameindex, info=None):
+                view = self._lockview(frameindex, info)
+                if view is None:
+                        return None
+                return numpy.asarray(view)
+
+        def lockframe(self, frameindex, info=None):
+                """
+                Zero-copy access to a frame. Returns a LockedFrame, whose
+                view is released when its release() is called or the next
+                frame is locked.
+                """
+                view = self._lockview(frameindex, info)
+                if view is None:
+                        return None
+                if self._lockedframe is not None:
+                        self._lockedframe.release()
+                self._lockedframe = LockedFrame(self, view)
+                return self._lockedframe
+
+        def getframe_into(self, frameindex, out, info=None):
+                """
+                Copy a frame into a preallocated uint16 array of frame size.
+                Frame metadata is copied into info if it is a FrameInfo.
+                """
+                frameparam = self._frameparam
+                frameparam.iFrame = frameindex
+                retval = dcamapi.lockframe(self._hdcam, frameparam)
+                if retval != dcamapi.DCERR.SUCCESS:
+                        print('Could not lock frame')
+                        return False
+                if info is not None:
+                        info.update(frameparam)
+                if out.shape != (frameparam.height, frameparam.width):
+                        print('Output does not match frame size')
+                        return False
+                rowbytes = frameparam.width*2
+                if out.flags['C_CONTIGUOUS'] and frameparam.rowbytes == rowbytes:
+                        ctypes.memmove(out.ctypes.data, frameparam.buf, rowbytes*frameparam.height)
+                else:
+                        data_pointer = ctypes.cast(frameparam.buf, ctypes.POINTER(ctypes.c_uint16))
+                        data_array = numpy.ctypeslib.as_array(data_pointer, shape=(frameparam.height, frameparam.rowbytes//2))
+                        out[...] = data_array[:, :frameparam.width]
+                return True
 
         def getproplist(self, option):
                 proplist = []
@@ -223,15 +361,98 @@ class Camera:
                         return None
                 return attrparam
 
-        def getpropvalue(self, propid):
+        def getpropvalue(self, propid, cached=False):
+                """
+                Get a property. With cached=True, the effective value of the
+                last setpropvalue() is returned without asking the camera.
+                """
+                if cached and propid in self._propcache:
+                        return self._propcache[propid][1]
                 return dcamapi.getpropvalue(self._hdcam, propid)
 
+        def _ispropset(self, propid, value):
+                return propid in self._propcache and value in self._propcache[propid]
+
         def setpropvalue(self, propid, value):
-                retval = dcamapi.setpropvalue(self._hdcam, propid, value)
-                if retval != dcamapi.DCERR.SUCCESS:
+                """
+                Set a property and cache the effective value read back from
+                the camera, which may be rounded or clamped. Setting a value
+                that was already set is skipped.
+                """
+                if self._ispropset(propid, value):
+                        return True
+                effective = dcamapi.setgetpropvalue(self._hdcam, propid, value)
+                if effective is None:
+                        self._propcache.pop(propid, None)
                         return False
+                self._propcache[propid] = (value, effective)
                 return True
 
+        def setpropvalues(self, props):
+                """
+                Set several properties in one transaction. props is a list of
+                (propid, value) pairs or a dict. Values that are already set
+                are skipped. Properties that change the frame size, and any
+                that cannot be set during capture, are applied with capture
+                stopped and the buffer released, which happens at most once.
+                Capture and the buffer are restored afterwards.
+                """
+                if isinstance(props, dict):
+                        props = props.items()
+                changes = [(propid, value) for propid, value in props
+                           if not self._ispropset(propid, value)]
+                if len(changes) == 0:
+                        return True
+
+                resize = any(propid in _RESIZE_PROPS for propid, value in changes)
+
+                # Try to apply without stopping capture first
+                if self._bCapturing and not resize:
+                        changes = [(propid, value) for propid, value in changes
+                                   if not self.setpropvalue(propid, value)]
+                        if len(changes) == 0:
+                                return True
+
+                # Subarray size and position can only change with subarray mode off
+                mode = dcamapi.DCAMIDPROP.SUBARRAYMODE
+                mode_on = dcamapi.DCAMPROPMODEVALUE.MODE__ON
+                mode_off = dcamapi.DCAMPROPMODEVALUE.MODE__OFF
+                ids = [propid for propid, value in changes]
+                if any(propid in _SUBARRAY_PROPS for propid in ids):
+                        current = self.getpropvalue(mode, cached=True)
+                        if mode in ids:
+                                target = dict(changes)[mode]
+                                changes = [item for item in changes if item[0] != mode]
+                        else:
+                                target = current
+                        if current == mode_on:
+                                changes = [(mode, mode_off)] + changes
+                        if target == mode_on or mode in ids:
+                                changes = changes + [(mode, target)]
+
+                capturing = self._bCapturing
+                nframes = self._nAllocatedFrames
+                if capturing:
+                        self.stopcapture()
+                if self._bAlloc:
+                        self.unpreparecapture()
+
+                success = True
+                for propid, value in changes:
+                        if not self.setpropvalue(propid, value):
+                                print('Could not set property', hex(propid))
+                                success = False
+                                break
+
+                if nframes > 0:
+                        success = self.preparecapture(self._mCaptureMode, nframes) and success
+                if capturing:
+                        success = self.startcapture() and success
+                return success
+
+        def clearpropcache(self):
+                self._propcache = {}
+
         def getpropname(self, propid):
                 strsize = 64
                 pystring = " " * strsize
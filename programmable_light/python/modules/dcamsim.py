@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+'''
+    Simulated DCAM-API library, for running dcampy and hardware.HCamera
+    without a Hamamatsu camera. Set the environment variable DCAM_SIMULATE=1
+    before importing dcamapi to use it, and optionally
+        DCAM_SIM_FPS: Frame rate, default is 100
+        DCAM_SIM_SENSOR: Sensor size as HxW, default is 2048x2048
+        DCAM_SIM_DROPRATE: Probability of dropping a frame, default is 0
+'''
+
+# System imports
+import os
+import time
+import ctypes
+import threading
+
+# Numpy-ish imports
+import numpy as np
+
+from modules import dcamapi
+
+def from_environment():
+    '''
+        Create a simulated library configured by the DCAM_SIM_* environment
+        variables.
+    '''
+    fps = float(os.environ.get('DCAM_SIM_FPS', 100))
+    sensor = os.environ.get('DCAM_SIM_SENSOR', '2048x2048')
+    drop_rate = float(os.environ.get('DCAM_SIM_DROPRATE', 0))
+
+    sensor_size = tuple(int(size) for size in sensor.lower().split('x'))
+
+    return SimulatedDCAM(fps, sensor_size, drop_rate)
+
+# Properties that can be set while capturing, as on a real camera
+_LIVE_PROPS = (dcamapi.DCAMIDPROP.EXPOSURETIME,)
+
+def _error(code):
+    '''
+        DCAMERR codes are returned as signed 32 bit integers by the library.
+    '''
+    return ctypes.c_int32(code).value
+
+def _deref(arg):
+    '''
+        Get the ctypes object behind a byref() argument.
+    '''
+    return getattr(arg, '_obj', arg)
+
+def _value(arg):
+    '''
+        Get the python value of a ctypes scalar argument, or a handle.
+    '''
+    return getattr(arg, 'value', arg)
+
+class SimulatedDCAM(object):
+    '''
+        Drop-in replacement for the DCAM-API shared library. Each exported
+        function of the library used by dcamapi is a method with the same
+        name. Frames are a synthetic uint16 ramp, with the frame stamp
+        modulo 1024 added to the first pixels, produced at a fixed frame
+        rate with optional randomly dropped frames.
+    '''
+    def __init__(self, fps=100.0, sensor_size=(2048, 2048), drop_rate=0.0,
+                 ncameras=1, seed=0):
+        '''
+            Create a simulated library.
+
+            Inputs:
+                fps: Frame rate in frames per second. Default is 100
+                sensor_size: Two-tuple (H, W) of the sensor
+                drop_rate: Probability of a frame being dropped. Default is 0
+                ncameras: Number of simulated cameras. Default is 1
+                seed: Seed for dropping frames
+
+            Outputs:
+                None
+        '''
+        self.fps = fps
+        self.sensor_size = sensor_size
+        self.drop_rate = drop_rate
+        self.ncameras = ncameras
+
+        self._rng = np.random.RandomState(seed)
+        self._lock = threading.Lock()
+
+        prop = dcamapi.DCAMIDPROP
+        mode = dcamapi.DCAMPROPMODEVALUE
+        self._props = {
+            prop.EXPOSURETIME: 0.01,
+            prop.BINNING: mode.BINNING__1,
+            prop.SUBARRAYHPOS: 0,
+            prop.SUBARRAYVPOS: 0,
+            prop.SUBARRAYHSIZE: sensor_size[1],
+            prop.SUBARRAYVSIZE: sensor_size[0],
+            prop.SUBARRAYMODE: mode.MODE__OFF,
+            prop.TRIGGERSOURCE: mode.TRIGGERSOURCE__INTERNAL,
+            prop.TRIGGER_GLOBALEXPOSURE: 0,
+        }
+
+        self._ring = None
+        self._capturing = False
+
+        # Abort only interrupts waits that are in progress
+        self._aborted = threading.Event()
+        self._nwaiting = 0
+
+    # ==== Frame generation ====
+
+    def _image_size(self):
+        '''
+            Get (H, W) of frames for the current binning and subarray.
+        '''
+        prop = dcamapi.DCAMIDPROP
+        binning = int(self._props[prop.BINNING])
+
+        if self._props[prop.SUBARRAYMODE] == dcamapi.DCAMPROPMODEVALUE.MODE__ON:
+            H = int(self._props[prop.SUBARRAYVSIZE])
+            W = int(self._props[prop.SUBARRAYHSIZE])
+        else:
+            H, W = self.sensor_size
+
+        return H//binning, W//binning
+
+    def _frame_period(self):
+        '''
+            Time between frames, limited by exposure time.
+        '''
+        return max(1.0/self.fps,
+                   self._props[dcamapi.DCAMIDPROP.EXPOSURETIME])
+
+    def _update(self):
+        '''
+            Write all frames that are due by now into the ring buffer.
+        '''
+        if not self._capturing:
+            return
+
+        now = time.perf_counter()
+        source = self._props[dcamapi.DCAMIDPROP.TRIGGERSOURCE]
+
+        if source == dcamapi.DCAMPROPMODEVALUE.TRIGGERSOURCE__SOFTWARE:
+            due = [t for t in self._triggers if t <= now]
+            self._triggers = [t for t in self._triggers if t > now]
+            times = due
+        else:
+            ndue = int((now - self._tstart)/self._frame_period())
+            times = [self._tstart + (k + 1)*self._frame_period()
+                     for k in range(self._nexposed, ndue)]
+
+        for tframe in times:
+            stamp = self._nexposed
+            self._nexposed += 1
+
+            if self._rng.rand() < self.drop_rate:
+                continue
+
+            # Every slot already holds the ramp, so only the first pixels
+            # are stamped. Writing whole frames would cost more than the
+            # capture paths being benchmarked.
+            slot = self._count % self._ring.shape[0]
+            np.add(self._base[0, :self._nstamp], stamp % 1024,
+                   out=self._ring[slot, 0, :self._nstamp])
+            self._stamps[slot] = stamp
+            self._times[slot] = tframe
+            self._count += 1
+
+    # ==== dcamapi ====
+
+    def dcamapi_init(self, initparam):
+        _deref(initparam).iDeviceCount = self.ncameras
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamapi_uninit(self):
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamdev_open(self, openparam):
+        param = _deref(openparam)
+        if param.index >= self.ncameras:
+            return _error(dcamapi.DCERR.NOCAMERA)
+        param.hdcam = param.index + 1
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamdev_close(self, hdcam):
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamdev_getstring(self, hdcam, stringparam):
+        return _error(dcamapi.DCERR.NOTSUPPORT)
+
+    def dcamdev_getcapability(self, hdcam, capparam):
+        return _error(dcamapi.DCERR.NOTSUPPORT)
+
+    # ==== dcamwait ====
+
+    def dcamwait_open(self, waitopenparam):
+        _deref(waitopenparam).hwait = 1
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamwait_close(self, hwait):
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamwait_abort(self, hwait):
+        with self._lock:
+            if self._nwaiting > 0:
+                self._aborted.set()
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamwait_start(self, hwait, waitstartparam):
+        param = _deref(waitstartparam)
+        tend = time.perf_counter() + param.timeout/1000.0
+
+        with self._lock:
+            self._update()
+            if not self._capturing:
+                return _error(dcamapi.DCERR.NOTBUSY)
+            target = self._count + 1
+            self._nwaiting += 1
+
+        try:
+            while True:
+                if self._aborted.is_set():
+                    return _error(dcamapi.DCERR.ABORT)
+
+                with self._lock:
+                    self._update()
+                    if self._count >= target:
+                        param.eventhappened = \
+                                dcamapi.WAIT_EVENT.CAP_FRAMEREADY
+                        return dcamapi.DCERR.SUCCESS
+
+                now = time.perf_counter()
+                if now > tend:
+                    return _error(dcamapi.DCERR.TIMEOUT)
+                time.sleep(min(0.0005, tend - now))
+        finally:
+            # The abort is used up once all waits have returned
+            with self._lock:
+                self._nwaiting -= 1
+                if self._nwaiting == 0:
+                    self._aborted.clear()
+
+    # ==== dcambuf ====
+
+    def dcambuf_alloc(self, hdcam, frames):
+        H, W = self._image_size()
+        self._ring = np.zeros((_value(frames), H, W), dtype=np.uint16)
+        self._stamps = np.zeros(_value(frames), dtype=np.int64)
+        self._times = np.zeros(_value(frames))
+
+        # Horizontal ramp. The first pixels of each frame are offset by
+        # the frame stamp modulo 1024.
+        ramp = np.linspace(0, 60000, W).astype(np.uint16)
+        self._base = np.tile(ramp, (H, 1))
+        self._ring[...] = self._base
+        self._nstamp = min(8, W)
+
+        return dcamapi.DCERR.SUCCESS
+
+    def dcambuf_release(self, hdcam, kind=0):
+        self._ring = None
+        return dcamapi.DCERR.SUCCESS
+
+    def dcambuf_lockframe(self, hdcam, frameparam):
+        param = _deref(frameparam)
+
+        with self._lock:
+            self._update()
+            if self._ring is None or self._count == 0:
+                return _error(dcamapi.DCERR.INVALIDFRAMEINDEX)
+
+            depth = self._ring.shape[0]
+            idx = param.iFrame
+            if idx == -1:
+                idx = (self._count - 1) % depth
+            if idx >= depth or idx >= self._count:
+                return _error(dcamapi.DCERR.INVALIDFRAMEINDEX)
+
+            H, W = self._ring.shape[1:]
+            param.buf = self._ring[idx].ctypes.data
+            param.rowbytes = 2*W
+            param.width = W
+            param.height = H
+            param.framestamp = int(self._stamps[idx])
+            param.timestamp.sec = int(self._times[idx])
+            param.timestamp.microsec = int((self._times[idx] % 1)*1e6)
+
+        return dcamapi.DCERR.SUCCESS
+
+    # ==== dcamcap ====
+
+    def dcamcap_start(self, hdcam, mode):
+        if self._ring is None:
+            return _error(dcamapi.DCERR.NOTREADY)
+
+        with self._lock:
+            self._tstart = time.perf_counter()
+            self._count = 0
+            self._nexposed = 0
+            self._triggers = []
+            self._capturing = True
+
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamcap_stop(self, hdcam):
+        self._capturing = False
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamcap_transferinfo(self, hdcam, transferparam):
+        param = _deref(transferparam)
+
+        with self._lock:
+            self._update()
+            if self._ring is None:
+                return _error(dcamapi.DCERR.NOTREADY)
+            param.nFrameCount = self._count
+            param.nNewestFrameIndex = (self._count - 1) % self._ring.shape[0]
+
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamcap_firetrigger(self, hdcam, option):
+        with self._lock:
+            if not self._capturing:
+                return _error(dcamapi.DCERR.NOTBUSY)
+            exposure = self._props[dcamapi.DCAMIDPROP.EXPOSURETIME]
+            self._triggers.append(time.perf_counter() + exposure)
+
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamcap_record(self, hdcam, hrec):
+        return _error(dcamapi.DCERR.NOTSUPPORT)
+
+    # ==== dcamprop ====
+
+    def dcamprop_getvalue(self, hdcam, propid, value):
+        propid = _value(propid)
+        prop = dcamapi.DCAMIDPROP
+
+        if propid == prop.IMAGE_HEIGHT:
+            _deref(value).value = self._image_size()[0]
+        elif propid == prop.IMAGE_WIDTH:
+            _deref(value).value = self._image_size()[1]
+        elif propid in self._props:
+            _deref(value).value = self._props[propid]
+        else:
+            return _error(dcamapi.DCERR.INVALIDPROPERTYID)
+
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamprop_setvalue(self, hdcam, propid, value):
+        propid = _value(propid)
+
+        if self._capturing and propid not in _LIVE_PROPS:
+            return _error(dcamapi.DCERR.ACCESSDENY)
+        if propid not in self._props:
+            return _error(dcamapi.DCERR.INVALIDPROPERTYID)
+
+        value = _value(value)
+        if propid == dcamapi.DCAMIDPROP.EXPOSURETIME:
+            value = min(max(value, 1e-4), 10.0)
+        self._props[propid] = value
+
+        return dcamapi.DCERR.SUCCESS
+
+    def dcamprop_setgetvalue(self, hdcam, propid, value, option):
+        param = _deref(value)
+        retval = self.dcamprop_setvalue(hdcam, propid, param.value)
+        if retval != dcamapi.DCERR.SUCCESS:
+            return retval
+
+        param.value = self._props[_value(propid)]
+        return dcamapi.DCERR.SUCCESS
@@ -22,7 +22,7 @@ from modules import hardware
 from modules import coding
 from modules import utils
 
-def grab_im(camera, port, trig, navg, ndrops=1):
+def grab_im(camera, port, trig, navg, ndrops=1, accumulator=None):
     '''
         Function to trigger and capture images
 
@@ -32,58 +32,62 @@ def grab_im(camera, port, trig, navg, ndrops=1):
             trig: Character to send for firing a trigger
             navg: Number of averages
             ndrops: Number of captures to discard
+            accumulator: Optional utils.FrameAccumulator to average with.
+                Reuse one across calls to avoid allocations.
 
         Outputs:
             im: Captured image
     '''
+    if accumulator is None:
+        accumulator = utils.FrameAccumulator()
+    accumulator.reset()
+
     # First keep discarding
     for idx in range(ndrops):
         port.write(trig.encode())
         discard = camera.capture(1)
 
     # Now capture diligently
-    im = 0
     for idx in range(navg):
         # Trigger
         port.write(trig.encode())
 
         # Capture
-        im += camera.capture(1).astype(np.float32)
-
-    im /= navg
+        accumulator.add(camera.capture(1))
 
-    return im
+    return accumulator.mean()
 
-def grab_im_software_trigger(camera, navg, ndrops=1):
+def grab_im_software_trigger(camera, navg, ndrops=1, accumulator=None):
     '''
         Function to trigger and capture images
 
         Inputs:
             camera: Hamamatsu camera object
-            port: Serial port to control Arduino
-            trig: Character to send for firing a trigger
             navg: Number of averages
             ndrops: Number of captures to discard
+            accumulator: Optional utils.FrameAccumulator to average with.
+                Reuse one across calls to avoid allocations.
 
         Outputs:
             im: Captured image
     '''
+    if accumulator is None:
+        accumulator = utils.FrameAccumulator()
+    accumulator.reset()
+
     # First keep discarding
     for idx in range(ndrops):
         camera.fire_trigger()
         discard = camera.capture(1)
 
     # Now capture diligently
-    im = 0
     for idx in range(navg):
         # Trigger
         camera.fire_trigger()
         # Capture
-        im += camera.capture(1).astype(np.float32)
-
-    im /= navg
+        accumulator.add(camera.capture(1))
 
-    return im
+    return accumulator.mean()
 
 
 def get_setup_profile(profile, wvl, target_wvl, code):
@@ -9,9 +9,15 @@
 # System imports
 import os
 import sys
-import pdb
+import copy
+import time
+import queue
 import ctypes
 import socket
+import zlib
+import threading
+import collections
+import concurrent.futures
 from tqdm import tqdm
 
 # Paths for drivers and dlls
@@ -37,6 +43,8 @@ import matplotlib.pyplot as plt
 
 # Hacky way of getting SDL2 path
 from modules import this_path
+from modules import coding
+from modules import utils
 SDL_HOME = this_path.__file__.replace('this_path.py', 'libsdl/')
 
 # Set global environment variables
@@ -159,7 +167,8 @@ class Display(object):
         Relies on SDL2 library
     '''
     def __init__(self, screen_id=0, window_name='New window', initialize=True,
-                 delay=5):
+                 delay=5, cache_budget=0, streaming=False, grayscale=False,
+                 backend='sdl', size=None, instrument=0, readback=0):
         '''
             Initializer for display class.
 
@@ -168,6 +177,26 @@ class Display(object):
                 window_name: Name of the window. Default is 'New window'
                 initialize: If True, initialize video system.
                 delay: Time delay after rendering in milliseconds
+                cache_budget: Maximum number of bytes of VRAM used for caching
+                    textures of patterns repeated with showData. Default is
+                    0, which disables the cache.
+                streaming: If True, frames without a texture are uploaded to a
+                    single persistent streaming texture instead of creating
+                    a new texture per frame.
+                grayscale: If True, images must be 2D and are uploaded as a
+                    single 8-bit plane instead of being expanded to RGB.
+                backend: 'sdl' (default) for a fullscreen window on a real
+                    screen, or 'null' for an offscreen window using the SDL
+                    dummy video driver and software renderer. The null
+                    backend needs no screen.
+                size: Two-tuple (H, W) of the screen for the null backend.
+                    Default is the size of the dummy screen.
+                instrument: Number of frames for which timing is recorded in
+                    a ring buffer. Default is 0, which disables timing.
+                readback: Null backend only. Number of presented frames
+                    recorded in self.history as (timestamp, CRC32) tuples.
+                    Each presented frame is also copied to self.framebuffer.
+                    Default is 0, which disables the readback.
 
             Outputs:
                 None
@@ -175,34 +204,128 @@ class Display(object):
         self.id = screen_id
         self.window_name = window_name
         self.delay = delay
+        self.streaming = streaming
+        self.grayscale = grayscale
+        self.backend = backend
+
+        if backend not in ['sdl', 'null']:
+            raise ValueError('Backend %s not supported'%backend)
 
         # Use this for saving created surfaces.
         self._counter = 0
 
+        # Texture cache of showData, keyed by pattern content and kept in
+        # least recently used order. Values are (texture, nbytes) tuples.
+        # Cached textures are never handed out, so they can be evicted.
+        self.cache_budget = cache_budget
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        self._frame_nbytes = 0      # Size of one texture, once known
+
+        # Timing ring buffer. Each row holds upload start, upload end, render
+        # copy end and present return times (time.perf_counter) of a frame.
+        if instrument > 0:
+            self._timing = np.zeros((instrument, 4))
+        else:
+            self._timing = None
+        self._timing_idx = 0
+        self.dropped_frames = 0
+
+        # The dummy driver is picked up when the video system initializes
+        if backend == 'null':
+            videodriver = os.environ.get('SDL_VIDEODRIVER')
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+            self.id = 0
+
         # First, initialize SDL Video interface
         if initialize:
             sdl2.SDL_Init(sdl2.SDL_INIT_VIDEO)
 
+        # Later displays should not get the dummy driver
+        if backend == 'null':
+            if videodriver is None:
+                del os.environ['SDL_VIDEODRIVER']
+            else:
+                os.environ['SDL_VIDEODRIVER'] = videodriver
+
         # Find number of displays
         ndisplays = sdl2.SDL_GetNumVideoDisplays()
 
-        if ndisplays < screen_id+1:
+        if ndisplays < self.id+1:
             raise RuntimeError('Fewer displays than required')
 
         # Get screen bounds
         self.bounds = sdl2.SDL_Rect()
         ret = sdl2.SDL_GetDisplayBounds(self.id, self.bounds)
 
+        if (backend == 'null') and (size is not None):
+            self.bounds.h, self.bounds.w = size
+
         # Add bounds size as a member variable
         self.shape = [self.bounds.h, self.bounds.w]
 
+        # Get refresh rate of the screen for pacing sequences. SDL reports
+        # 0 when it is not known, in which case assume 60Hz.
+        mode = sdl2.SDL_DisplayMode()
+        sdl2.SDL_GetCurrentDisplayMode(self.id, mode)
+        if mode.refresh_rate > 0:
+            self.refresh_rate = mode.refresh_rate
+        else:
+            self.refresh_rate = 60
+
+        if backend == 'null':
+            self._create_null_window(readback)
+        else:
+            self._create_window()
+
+        # Now time to create the data buffer for screen image.
+        # XXX: Make sure the data is contiguous by setting order='c'
+        h = self.bounds.h
+        w = self.bounds.w
+
+        if self.grayscale:
+            # SDL renderers have no single channel texture format, so
+            # grayscale images are uploaded as the luma plane of an IYUV
+            # texture. With full range (JPEG) conversion and constant
+            # chroma of 128, luma maps exactly to R = G = B.
+            self._data = np.zeros((h, w), dtype=np.uint8, order='C')
+            self._chroma = np.full(((h+1)//2, (w+1)//2), 128, dtype=np.uint8)
+            self._chroma_ptr = self._chroma.ctypes.data_as(
+                                    ctypes.POINTER(ctypes.c_uint8))
+            sdl2.SDL_SetYUVConversionMode(
+                    sdl2.surface.SDL_YUV_CONVERSION_JPEG)
+
+            self._texture_format = sdl2.SDL_PIXELFORMAT_IYUV
+            self._surface = None
+        else:
+            self._data = np.zeros((h, w, 3), dtype=np.uint8, order='C')
+            self._texture_format = sdl2.SDL_PIXELFORMAT_RGB24
+
+            # Create the surface
+            self._create_surface()
+
+        # Create the persistent streaming texture if required
+        self._stream_texture = None
+        self._temp_texture = None
+        if self.streaming:
+            self._create_stream_texture()
+
+        # Start off by displaying the blank image
+        self.render()
+
+    def _create_window(self):
+        '''
+            Create a fullscreen window with a VSYNC locked renderer
+        '''
         # Create a new window
         flags = (sdl2.SDL_WINDOW_FULLSCREEN | sdl2.SDL_WINDOW_OPENGL |
                  sdl2.SDL_WINDOW_SHOWN)
 
         sdl2.SDL_GL_SetAttribute(sdl2.SDL_GL_SHARE_WITH_CURRENT_CONTEXT, 0)
 
-        self._window = sdl2.SDL_CreateWindow(window_name.encode(),
+        self._window = sdl2.SDL_CreateWindow(self.window_name.encode(),
                                              self.bounds.x,
                                              self.bounds.y,
                                              self.bounds.w,
@@ -223,17 +346,81 @@ class Display(object):
         if retval == -1:
             print('Adaptive VSYNC not supported')
 
-        # Now time to create the data buffer for screen image.
-        # XXX: Make sure the data is contiguous by setting order='c'
-        h = self.bounds.h
-        w = self.bounds.w
-        self._data = np.zeros((h, w, 3), dtype=np.uint8, order='C')
+    def _create_null_window(self, readback=0):
+        '''
+            Create an offscreen window with a software renderer, and the
+            framebuffer that presented frames are copied to if readback is
+            non-zero.
+        '''
+        self._window = sdl2.SDL_CreateWindow(self.window_name.encode(),
+                                             0, 0,
+                                             self.bounds.w,
+                                             self.bounds.h,
+                                             sdl2.SDL_WINDOW_HIDDEN)
+        if not self._window:
+            raise RuntimeError('Could not create window: %s'%
+                               sdl2.SDL_GetError().decode())
 
-        # Create the surface
-        self._create_surface()
+        # There is no GL context with a software renderer
+        self._glcontext = None
 
-        # Start off by displaying the blank image
-        self.render()
+        flags = (sdl2.SDL_RENDERER_SOFTWARE |
+                 sdl2.SDL_RENDERER_TARGETTEXTURE)
+        self._renderer = sdl2.SDL_CreateRenderer(self._window, -1, flags)
+
+        # Last presented frame, and (timestamp, CRC32) of the most recent
+        # ones
+        self._readback = readback > 0
+        if self._readback:
+            self.framebuffer = np.zeros((self.bounds.h, self.bounds.w, 3),
+                                        dtype=np.uint8)
+        else:
+            self.framebuffer = None
+        self.history = collections.deque(maxlen=readback)
+
+    def _make_current(self):
+        '''
+            Make the GL context of this display current.
+        '''
+        # https://stackoverflow.com/questions/22227811/ ...
+        # ... sdl2-and-opengl-functions-with-two-windows
+        #
+        # If handling multiple windows, you need to set the current GL
+        # context
+        if self._glcontext is not None:
+            sdl2.SDL_GL_MakeCurrent(self._window, self._glcontext)
+
+    def _set_vsync(self, enable):
+        '''
+            Turn waiting for VSYNC on presents on or off.
+        '''
+        # The software renderer of the null backend never waits
+        if self._glcontext is None:
+            return
+
+        self._make_current()
+
+        # SDL_RenderSetVSync needs SDL 2.0.18. Older versions only have the
+        # swap interval of the current context.
+        retval = -1
+        if hasattr(sdl2, 'SDL_RenderSetVSync'):
+            retval = sdl2.SDL_RenderSetVSync(self._renderer, int(enable))
+        if retval != 0:
+            retval = sdl2.SDL_GL_SetSwapInterval(int(enable))
+        if retval != 0:
+            print('Could not change VSYNC of %s'%self.window_name)
+
+    def _read_framebuffer(self):
+        '''
+            Copy the back buffer to self.framebuffer and record it.
+        '''
+        sdl2.SDL_RenderReadPixels(self._renderer, None,
+                                  sdl2.SDL_PIXELFORMAT_RGB24,
+                                  self.framebuffer.ctypes.data,
+                                  self.framebuffer.strides[0])
+
+        self.history.append((time.perf_counter(),
+                             zlib.crc32(self.framebuffer)))
 
     def _create_surface(self):
         '''
@@ -266,32 +453,160 @@ class Display(object):
                                                       ctypes.c_uint32(bmask),
                                                       ctypes.c_uint32(amask))
 
-    def create_textures_from_stack(self, imstack):
+    def _create_stream_texture(self):
+        '''
+            Create a streaming texture of screen size, which is updated in
+            place from the data buffer on every render.
+        '''
+        self._stream_texture = sdl2.SDL_CreateTexture(
+                self._renderer,
+                self._texture_format,
+                sdl2.SDL_TEXTUREACCESS_STREAMING,
+                self.bounds.w,
+                self.bounds.h)
+
+        if not self._stream_texture:
+            raise RuntimeError('Could not create streaming texture: %s'%
+                               sdl2.SDL_GetError().decode())
+
+        # Pre-allocate the arguments for locking the texture
+        self._lock_pixels = ctypes.c_void_p()
+        self._lock_pitch = ctypes.c_int()
+
+    def _update_stream_texture(self):
+        '''
+            Copy the data buffer into the streaming texture.
+        '''
+        if self.grayscale:
+            self._update_gray_texture(self._stream_texture, self._data)
+            return
+
+        sdl2.SDL_LockTexture(self._stream_texture, None,
+                             ctypes.byref(self._lock_pixels),
+                             ctypes.byref(self._lock_pitch))
+
+        rowbytes = self._data.strides[0]
+        pitch = self._lock_pitch.value
+        dst = self._lock_pixels.value
+        src = self._data.ctypes.data
+
+        # The texture rows may be padded, in which case copy row by row
+        if pitch == rowbytes:
+            ctypes.memmove(dst, src, self._data.nbytes)
+        else:
+            for row in range(self.bounds.h):
+                ctypes.memmove(dst + row*pitch, src + row*rowbytes, rowbytes)
+
+        sdl2.SDL_UnlockTexture(self._stream_texture)
+
+    def _update_gray_texture(self, texture, im):
+        '''
+            Upload a contiguous uint8 grayscale image as the luma plane of
+            an IYUV texture.
+        '''
+        luma_ptr = im.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8))
+        cpitch = self._chroma.strides[0]
+
+        sdl2.SDL_UpdateYUVTexture(texture, None,
+                                  luma_ptr, im.strides[0],
+                                  self._chroma_ptr, cpitch,
+                                  self._chroma_ptr, cpitch)
+
+    def _copy_to_data(self, im):
+        '''
+            Copy an image into the data buffer after checking its size.
+            Grayscale images are broadcast over the color channels without a
+            temporary copy.
+        '''
+        # Make sure the size of image matches size of screen
+        [H, W] = im.shape[:2]
+
+        if (H != self.bounds.h) or (W != self.bounds.w):
+            raise ValueError('Image must be same size as screen')
+
+        if self.grayscale:
+            if np.ndim(im) != 2:
+                raise ValueError('Grayscale display requires 2D images')
+            self._data[:, :] = im
+        elif np.ndim(im) == 2:
+            self._data[:, :, :] = im[:, :, np.newaxis]
+        else:
+            self._data[:, :, :] = im[:, :, :]
+
+    def create_textures_from_stack(self, imstack, axis=2, chunk_size=32):
         '''
             Create a list of textures from a 3D numpy stack.
 
+            The stack is converted to uint8 a chunk of images at a time, and
+            each image is uploaded straight from the contiguous chunk. On
+            RGB displays, images are expanded to three channels while
+            converting. The textures are owned by the caller and bypass the
+            texture cache.
+
             Inputs:
-                imstack: Numpy stack of arrays (H x W x nimg). Values must
-                    be normalized between 0, 1 before passing.
+                imstack: Numpy stack of arrays (H x W x nimg), or path to a
+                    .npy file with such a stack, which is then memory-mapped
+                    and read lazily. Values must be normalized between 0, 1
+                    before passing, unless the stack is uint8.
+                axis: Axis of imstack that indexes images. Default is 2. Use
+                    0 for (nimg x H x W) stacks, which is the fastest layout
+                    for memory-mapped stacks.
+                chunk_size: Number of images converted at a time. Default
+                    is 32
 
             Outputs:
                 textures: List of texture for each image
         '''
-        textures = []
+        if isinstance(imstack, str):
+            imstack = np.load(imstack, mmap_mode='r')
+
+        # View the stack as nimg x H x W without copying
+        imstack = np.moveaxis(imstack, axis, 0)
+        nimg = imstack.shape[0]
 
-        if imstack.dtype == np.uint8:
-            pass
+        [H, W] = imstack.shape[1:3]
+        if (H != self.bounds.h) or (W != self.bounds.w):
+            raise ValueError('Image must be same size as screen')
+
+        # Chunk buffer in which images are contiguous, in the layout of the
+        # texture format
+        if self.grayscale:
+            shape = (H, W)
         else:
-            imstack = (imstack*255).astype(np.uint8)
+            shape = (H, W, 3)
+        chunk = np.empty((min(chunk_size, nimg),) + shape, dtype=np.uint8)
+
+        textures = []
+        pbar = tqdm(total=nimg)
+
+        for start in range(0, nimg, chunk_size):
+            nchunk = min(chunk_size, nimg - start)
+            src = imstack[start:start+nchunk]
+            dst = chunk[:nchunk]
+
+            # Broadcast gray images over the color channels
+            if src.ndim < dst.ndim:
+                src = src[..., np.newaxis]
+
+            if imstack.dtype == np.uint8:
+                np.copyto(dst, src)
+            else:
+                np.multiply(src, 255, out=dst, casting='unsafe')
+
+            for idx in range(nchunk):
+                textures.append(self._create_texture(dst[idx]))
 
-        for idx in tqdm(range(imstack.shape[2])):
-            textures.append(self.create_texture_from_numpy(imstack[:, :, idx]))
+            pbar.update(nchunk)
+
+        pbar.close()
 
         return textures
 
     def create_texture_from_numpy(self, im):
         '''
             Create texture from a numpy array by saving and loading image.
+            The texture is owned by the caller, also when the texture cache
+            is enabled.
 
             Inputs:
                 im: Numpy array (uint8)
@@ -299,17 +614,48 @@ class Display(object):
             Outputs:
                 texture: Created texture.
         '''
-        if np.ndim(im) == 2:
-            im = np.tile(im[:, :, np.newaxis], [1, 1, 3])
-
-        # Make sure the size of image matches size of screen
-        [H, W, _] = im.shape
+        return self._create_texture(im)
 
-        if (H != self.bounds.h) or (W != self.bounds.w):
-            raise ValueError('Image must be same size as screen')
+    def _create_texture(self, im):
+        '''
+            Upload a numpy array to a new texture, bypassing the cache.
+        '''
+        if self.grayscale:
+            # Upload straight from the image, without using the data buffer
+            [H, W] = im.shape[:2]
+            if (H != self.bounds.h) or (W != self.bounds.w):
+                raise ValueError('Image must be same size as screen')
+            if np.ndim(im) != 2:
+                raise ValueError('Grayscale display requires 2D images')
+
+            im = np.ascontiguousarray(im, dtype=np.uint8)
+            im_texture = sdl2.SDL_CreateTexture(self._renderer,
+                                                self._texture_format,
+                                                sdl2.SDL_TEXTUREACCESS_STATIC,
+                                                W, H)
+            self._update_gray_texture(im_texture, im)
+
+            return im_texture
+
+        # Contiguous RGB images, such as chunk slices, are uploaded straight
+        if (np.ndim(im) == 3) and (im.dtype == np.uint8) and \
+                im.flags['C_CONTIGUOUS']:
+            [H, W] = im.shape[:2]
+            if (H != self.bounds.h) or (W != self.bounds.w):
+                raise ValueError('Image must be same size as screen')
+
+            im_texture = sdl2.SDL_CreateTexture(self._renderer,
+                                                self._texture_format,
+                                                sdl2.SDL_TEXTUREACCESS_STATIC,
+                                                W, H)
+            sdl2.SDL_UpdateTexture(im_texture, None,
+                                   ctypes.c_void_p(im.ctypes.data),
+                                   im.strides[0])
+
+            return im_texture
 
         # Copy image data to our own buffer
-        self._data[:, :, :] = im[:, :, :]
+        self._copy_to_data(im)
 
         # Now create texture
         im_texture = sdl2.SDL_CreateTextureFromSurface(self._renderer,
@@ -317,7 +663,118 @@ class Display(object):
 
         return im_texture
 
+    def _texture_from_data(self):
+        '''
+            Upload the data buffer to a new texture.
+        '''
+        if self.grayscale:
+            return self._create_texture(self._data)
+
+        return sdl2.SDL_CreateTextureFromSurface(self._renderer, self._surface)
+
+    def _get_cached_texture(self, key=None):
+        '''
+            Look up the pattern in the data buffer in the texture cache,
+            uploading and inserting it on a miss. Least recently used
+            textures are destroyed until the cache fits within cache_budget.
+            The texture belongs to the cache and is only valid till the next
+            call.
+
+            Inputs:
+                key: Optional hashable key of the pattern. Default is a
+                    checksum of its content.
+
+            Outputs:
+                texture: Texture for the pattern
+                cached: False if the pattern was too large to be cached, in
+                    which case the caller owns the texture.
+        '''
+        if key is None:
+            key = self._hash_pattern(self._data)
+        else:
+            key = ('key', key)
+
+        if key in self._cache:
+            self.cache_hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key][0], True
+
+        self.cache_misses += 1
+        texture = self._texture_from_data()
+        nbytes = self._texture_nbytes(texture)
+        self._frame_nbytes = nbytes
+
+        # Patterns larger than the whole budget are never cached
+        if nbytes > self.cache_budget:
+            return texture, False
+
+        while self._cache and (self._cache_bytes + nbytes > self.cache_budget):
+            _, (old_texture, old_nbytes) = self._cache.popitem(last=False)
+            sdl2.SDL_DestroyTexture(old_texture)
+            self._cache_bytes -= old_nbytes
+
+        self._cache[key] = (texture, nbytes)
+        self._cache_bytes += nbytes
+
+        return texture, True
+
+    def _hash_pattern(self, im):
+        '''
+            Compute a content key for a pattern from its shape, type and a
+            CRC32 of its data, which costs about as much as copying it.
+        '''
+        im = np.ascontiguousarray(im)
+
+        return (im.shape, im.dtype.str, zlib.crc32(im))
+
+    def _texture_nbytes(self, texture):
+        '''
+            Estimate the VRAM used by a texture from its pixel format.
+        '''
+        fmt = ctypes.c_uint32()
+        w = ctypes.c_int()
+        h = ctypes.c_int()
+        sdl2.SDL_QueryTexture(texture, ctypes.byref(fmt), None,
+                              ctypes.byref(w), ctypes.byref(h))
+
+        # Planar YUV textures use 12 bits per pixel
+        if sdl2.SDL_ISPIXELFORMAT_FOURCC(fmt.value):
+            return (w.value*h.value*3)//2
+
+        return w.value*h.value*sdl2.SDL_BYTESPERPIXEL(fmt.value)
+
+    def cache_info(self):
+        '''
+            Get statistics of the texture cache.
+
+            Inputs: None
+
+            Outputs:
+                info: Dictionary with hits, misses, number of cached
+                    textures, bytes used and the byte budget.
+        '''
+        return {'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'ntextures': len(self._cache),
+                'nbytes': self._cache_bytes,
+                'budget': self.cache_budget}
+
+    def clear_cache(self):
+        '''
+            Destroy all cached textures and reset the counters.
+        '''
+        for texture, _ in self._cache.values():
+            sdl2.SDL_DestroyTexture(texture)
+
+        self._cache.clear()
+        self._cache_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def destroy_textures(self, textures):
+        '''
+            Destroy a list of textures.
+        '''
         for texture in textures:
             sdl2.SDL_DestroyTexture(texture)
 
@@ -325,46 +782,304 @@ class Display(object):
         '''
             Render the image to GPU buffer and onto screen for a given texture.
 
-            If texture is None, self._surface is used to create one.
+            If texture is None, self._data is shown. In streaming mode it is
+            copied into the persistent streaming texture, else a temporary
+            texture is created from self._surface and destroyed after
+            presenting.
         '''
-        # https://stackoverflow.com/questions/22227811/ ...
-        # ... sdl2-and-opengl-functions-with-two-windows
-        #
-        # If handling multiple windows, you need to set the current GL
-        # context
-        sdl2.SDL_GL_MakeCurrent(self._window, self._glcontext)
+        self._stage(texture)
+        self._present()
+
+    def _stage(self, texture=None, tstart=None):
+        '''
+            Copy a texture to the back buffer without presenting it. If
+            texture is None, self._data is used, same as render. tstart is
+            the time at which preparing the frame started, if before this
+            call.
+        '''
+        if self._timing is not None:
+            if tstart is None:
+                tstart = time.perf_counter()
+            row = self._timing[self._timing_idx % self._timing.shape[0]]
+            row[0] = tstart
+
+        self._make_current()
         
+        self._temp_texture = None
         if texture is None:
-            texture = sdl2.SDL_CreateTextureFromSurface(self._renderer,
-                                                        self._surface)
+            if self.streaming:
+                self._update_stream_texture()
+                texture = self._stream_texture
+            else:
+                texture = self._texture_from_data()
+                self._temp_texture = texture
+
+        if self._timing is not None:
+            row[1] = time.perf_counter()
 
         #sdl2.SDL_RenderClear(self._renderer)
         sdl2.SDL_RenderCopy(self._renderer, texture, None, None)
+
+        if self._timing is not None:
+            row[2] = time.perf_counter()
+
+    def _present(self):
+        '''
+            Present the back buffer, and destroy the temporary texture of
+            the last _stage call, if any.
+        '''
+        self._make_current()
+
+        # The back buffer is only defined before presenting
+        if self.backend == 'null' and self._readback:
+            self._read_framebuffer()
+
         sdl2.SDL_RenderPresent(self._renderer)
 
-    def showData(self, im):
+        if self._timing is not None:
+            nrecords = self._timing.shape[0]
+            row = self._timing[self._timing_idx % nrecords]
+            row[3] = time.perf_counter()
+
+            if self._timing_idx > 0:
+                tprev = self._timing[(self._timing_idx - 1) % nrecords, 3]
+
+                if row[0] - tprev < 1.0/self.refresh_rate:
+                    # The frame was meant to follow the previous one, so
+                    # every extra VSYNC period is a missed frame, whether
+                    # present blocked or the caller was late
+                    nintervals = int(round((row[3] - tprev)*self.refresh_rate))
+                    self.dropped_frames += max(nintervals - 1, 0)
+                else:
+                    # After the caller was idle, only a present that blocks
+                    # longer than a VSYNC period missed one
+                    self.dropped_frames += int((row[3] - row[2])*
+                                               self.refresh_rate)
+
+            self._timing_idx += 1
+
+        if self._temp_texture is not None:
+            sdl2.SDL_DestroyTexture(self._temp_texture)
+            self._temp_texture = None
+
+    def play_sequence(self, textures, frames_per_pattern=1, on_present=None,
+                      channels=None):
+        '''
+            Present a list of preloaded textures, each held on screen for an
+            exact number of VSYNC intervals. Every present blocks till VSYNC,
+            so no additional delay is used.
+
+            Inputs:
+                textures: List of textures, such as the output of
+                    create_textures_from_stack
+                frames_per_pattern: Number of VSYNC intervals to show each
+                    texture for. Default is 1
+                on_present: Function called as on_present(idx, timestamp)
+                    right after pattern idx is first presented. Use this to
+                    trigger the camera. Must return quickly.
+                channels: Optional list with a color channel (0, 1 or 2) for
+                    each texture. Only that channel of the texture is shown.
+
+            Outputs:
+                timestamps: Time (time.perf_counter, seconds) at which each
+                    pattern was first presented
+                nskipped: Number of VSYNC intervals missed while showing each
+                    pattern. Non-zero means the pattern stayed on longer.
+                ndoubled: Number of presents for each pattern that returned
+                    without waiting for a VSYNC. Non-zero means the pattern
+                    was shown for fewer intervals than required.
+        '''
+        npatterns = len(textures)
+        period = 1.0/self.refresh_rate
+
+        timestamps = np.zeros(npatterns)
+        nskipped = np.zeros(npatterns, dtype=int)
+        ndoubled = np.zeros(npatterns, dtype=int)
+
+        tprev = None
+        for idx, texture in enumerate(textures):
+            if channels is not None:
+                mask = [0, 0, 0]
+                mask[channels[idx]] = 255
+                sdl2.SDL_SetTextureColorMod(texture, *mask)
+
+            for frame in range(frames_per_pattern):
+                self._stage(texture)
+                self._present()
+                tnow = time.perf_counter()
+
+                # Compare time between presents with the VSYNC period
+                if tprev is not None:
+                    nintervals = int(round((tnow - tprev)/period))
+                    if nintervals == 0:
+                        ndoubled[idx] += 1
+                    elif nintervals > 1:
+                        nskipped[idx] += nintervals - 1
+                tprev = tnow
+
+                if frame == 0:
+                    timestamps[idx] = tnow
+                    if on_present is not None:
+                        on_present(idx, tnow)
+
+        # Remove channel masks
+        if channels is not None:
+            for texture in textures:
+                sdl2.SDL_SetTextureColorMod(texture, 255, 255, 255)
+
+        return timestamps, nskipped, ndoubled
+
+    def create_bitplane_textures(self, codes, bits_per_channel=8):
+        '''
+            Pack binary codes as bit planes of RGB textures. See
+            coding.pack_bitplanes.
+
+            Inputs:
+                codes: H x W x ncodes binary codes
+                bits_per_channel: 8 (default) for 24 codes per texture, for
+                    SLMs in bit-plane (color sequential) mode. 1 for 3 codes
+                    per texture, shown one at a time by channel masking.
+
+            Outputs:
+                textures: List of packed textures
+        '''
+        if self.grayscale:
+            raise ValueError('Bit plane textures need an RGB display')
+
+        frames = coding.pack_bitplanes(codes, bits_per_channel)
+
+        textures = []
+        for idx in range(frames.shape[3]):
+            textures.append(self._create_texture(frames[:, :, :, idx]))
+
+        return textures
+
+    def play_bitplanes(self, textures, ncodes, bits_per_channel=8,
+                       frames_per_pattern=1, on_present=None):
+        '''
+            Present binary codes packed with create_bitplane_textures.
+
+            With 8 bits per channel, each texture is presented once and the
+            SLM shows its 24 bit planes in sequence. With 1 bit per channel,
+            each code is presented separately by masking all other color
+            channels of its texture.
+
+            Inputs:
+                textures: Output of create_bitplane_textures
+                ncodes: Number of packed codes
+                bits_per_channel: 8 or 1, same as used for packing
+                frames_per_pattern, on_present: Same as play_sequence. Each
+                    pattern is a texture with 8 bits per channel, and a code
+                    with 1 bit per channel.
+
+            Outputs:
+                Same as play_sequence
+        '''
+        if bits_per_channel == 8:
+            return self.play_sequence(textures, frames_per_pattern,
+                                      on_present)
+
+        sequence = [textures[idx//3] for idx in range(ncodes)]
+        channels = [idx%3 for idx in range(ncodes)]
+
+        return self.play_sequence(sequence, frames_per_pattern, on_present,
+                                  channels)
+
+    def get_timing(self):
+        '''
+            Get the recorded timing of frames, oldest first.
+
+            Inputs: None
+
+            Outputs:
+                timing: nframes x 4 array with upload start, upload end,
+                    render copy end and present return times of each frame
+                    in seconds (time.perf_counter).
+        '''
+        if self._timing is None:
+            raise ValueError('Display was created without instrumentation')
+
+        nrecords = self._timing.shape[0]
+        if self._timing_idx <= nrecords:
+            return self._timing[:self._timing_idx].copy()
+
+        start = self._timing_idx % nrecords
+        return np.roll(self._timing, -start, axis=0)
+
+    def timing_histograms(self, nbins=50):
+        '''
+            Compute histograms of the recorded frame timing.
+
+            Inputs:
+                nbins: Number of histogram bins. Default is 50
+
+            Outputs:
+                histograms: Dictionary with (counts, bin_edges) in
+                    milliseconds for 'vsync_interval' (time between
+                    consecutive presents, leaving out frames that were
+                    started more than a VSYNC period after the previous
+                    present), 'upload' (upload start to end),
+                    'copy' (render copy) and 'present' (time blocked in
+                    present).
+                dropped: Number of VSYNC periods missed between presents of
+                    frames that were meant to follow each other, and by
+                    presents that blocked longer than a VSYNC period.
+        '''
+        timing = self.get_timing()*1000
+
+        # Frames started after the caller was idle have no VSYNC interval
+        period = 1000.0/self.refresh_rate
+        intervals = np.diff(timing[:, 3])
+        idle = (timing[1:, 0] - timing[:-1, 3]) >= period
+
+        durations = {'vsync_interval': intervals[~idle],
+                     'upload': timing[:, 1] - timing[:, 0],
+                     'copy': timing[:, 2] - timing[:, 1],
+                     'present': timing[:, 3] - timing[:, 2]}
+
+        histograms = {}
+        for name in durations:
+            histograms[name] = np.histogram(durations[name], nbins)
+
+        return histograms, self.dropped_frames
+
+    def reset_timing(self):
+        '''
+            Clear the recorded timing and the dropped frame counter.
+        '''
+        self._timing_idx = 0
+        self.dropped_frames = 0
+
+    def showData(self, im, key=None):
         '''
             Display a given image.
 
             Inputs:
                 im: Image of same size as screen. Can be either RGB or grayscale
+                key: Optional hashable key that identifies the image in the
+                    texture cache, such as its index in a pattern sequence.
+                    Saves computing a checksum of the image. Default is None
 
             Outputs: None
         '''
-        if np.ndim(im) == 2:
-            im = np.tile(im[:, :, np.newaxis], [1, 1, 3])
+        tstart = time.perf_counter()
 
-        # Make sure the size of image matches size of screen
-        [H, W, _] = im.shape
-
-        if (H != self.bounds.h) or (W != self.bounds.w):
-            raise ValueError('Image must be same size as screen')
+        # Copy image data to our own buffer, which is also what render
+        # shows later
+        self._copy_to_data(im)
 
-        # Copy image data to our own buffer
-        self._data[:, :, :] = im[:, :, :]
+        # Repeated patterns are rendered straight from the cache. Once a
+        # texture is known not to fit in the budget, the cache is skipped.
+        texture = None
+        cached = False
+        if 0 < self.cache_budget and self._frame_nbytes <= self.cache_budget:
+            texture, cached = self._get_cached_texture(key)
 
         # And then render
-        self.render()
+        self._stage(texture, tstart)
+        if texture is not None and not cached:
+            self._temp_texture = texture
+        self._present()
 
         # Wait for it to update for
         sdl2.SDL_Delay(self.delay)
@@ -376,181 +1091,1193 @@ class Display(object):
         # Python has a problem when closing the window -- the window
         # disappears only when python is closed. So just display all black
         # and then close
-        self._data[:, :, :] = 0
+        self._data[...] = 0
         self.render()
 
+        # Free all cached textures
+        self.clear_cache()
+
+        if self._stream_texture is not None:
+            sdl2.SDL_DestroyTexture(self._stream_texture)
+
         # Now it is okay to close
         sdl2.SDL_DestroyWindow(self._window)
-        sdl2.SDL_FreeSurface(self._surface)
+        if self._surface is not None:
+            sdl2.SDL_FreeSurface(self._surface)
         sdl2.SDL_Quit()
 
-class HCamera(object):
+class DisplayGroup(object):
     '''
-        Camera class wrapper for Hamamatsu camera. Uses DCAM API provided by
-        Hamamatsu folks. Thanks a lot!
+        Present on several displays in lockstep, such as an SLM and an
+        OLED. Textures for all displays are staged first, and then presented
+        back to back with a single call.
+
+        By default every display waits for its own VSYNC, so presents are
+        tear free, but each present waits for the next VSYNC after the
+        previous one returns. Displays can then be up to a frame apart, and
+        the group advances at most once per VSYNC of each display.
+
+        With single_vsync=True, only the last display waits for VSYNC. It is
+        presented first, and the other displays are presented right after it
+        returns, so the group advances once per VSYNC. The other displays
+        then switch at an arbitrary point of their scanout and tear, so a
+        camera exposure can see half of the old and half of the new pattern
+        on them.
     '''
-    def __init__(self, cam_num=0, exposure_time=10, binning=1, mode=0,
-                 roi_pos=[0, 0], roi_size=[512, 512], waittime=5000,
-                 fast=False):
+    def __init__(self, displays, single_vsync=False):
+        '''
+            Create a group of displays.
+
+            Inputs:
+                displays: List of Display objects
+                single_vsync: If True, VSYNC is turned off for all but the
+                    last display, which paces the group. See above for the
+                    tearing this causes. Default is False
+
+            Outputs:
+                None
+        '''
+        self.displays = list(displays)
+        self.single_vsync = single_vsync
+        self.skew = 0
+
+        if single_vsync:
+            for display in self.displays[:-1]:
+                display._set_vsync(False)
+
+    def stage(self, textures):
+        '''
+            Copy textures to the back buffer of each display.
+
+            Inputs:
+                textures: List with one entry per display. Each entry is a
+                    texture, an image of the same size as that display, or
+                    None to show the data buffer of the display.
+
+            Outputs:
+                None
+        '''
+        if len(textures) != len(self.displays):
+            raise ValueError('Need one texture per display')
+
+        for display, texture in zip(self.displays, textures):
+            if isinstance(texture, np.ndarray):
+                display._copy_to_data(texture)
+                texture = None
+            display._stage(texture)
+
+    def present(self):
+        '''
+            Present the staged textures on all displays back to back. With
+            single_vsync, the last display is presented first.
+
+            Inputs: None
+
+            Outputs:
+                timestamps: Time (time.perf_counter, seconds) at which each
+                    display returned from its present
+                skew: Time between the first and the last present, also
+                    saved as self.skew
+        '''
+        timestamps = np.zeros(len(self.displays))
+
+        ndisplays = len(self.displays)
+        if self.single_vsync:
+            order = [ndisplays - 1] + list(range(ndisplays - 1))
+        else:
+            order = range(ndisplays)
+
+        for idx in order:
+            self.displays[idx]._present()
+            timestamps[idx] = time.perf_counter()
+
+        self.skew = timestamps.max() - timestamps.min()
+
+        return timestamps, self.skew
+
+    def show(self, textures):
+        '''
+            Stage and present textures on all displays. See stage and
+            present for inputs and outputs.
+        '''
+        self.stage(textures)
+
+        return self.present()
+
+    def close(self):
+        '''
+            Close all displays
+        '''
+        for display in self.displays:
+            if self.single_vsync:
+                display._set_vsync(True)
+            display.close()
+
+class DisplayThread(object):
+    '''
+        Run a Display in a dedicated thread that owns the SDL/GL context.
+        Commands are put in a bounded queue and return futures, so the caller
+        can prepare the next pattern or read out a camera while the current
+        pattern is being presented.
+    '''
+    def __init__(self, queue_depth=4, **display_kwargs):
+        '''
+            Create the display thread.
+
+            Inputs:
+                queue_depth: Maximum number of pending commands. Submitting
+                    to a full queue blocks till the thread catches up.
+                display_kwargs: Arguments for Display
+
+            Outputs:
+                None
+        '''
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._ready = threading.Event()
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run,
+                                        args=(display_kwargs,),
+                                        daemon=True)
+        self._thread.start()
+
+        # Wait till the display is created in the thread
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+
+        self.shape = self.display.shape
+
+    def _run(self, display_kwargs):
+        '''
+            Thread loop, which creates the display and drains the queue.
+        '''
+        try:
+            self.display = Display(**display_kwargs)
+        except Exception as err:
+            self._error = err
+            self._ready.set()
+            return
+
+        self._ready.set()
+
+        while True:
+            func, args, future = self._queue.get()
+
+            # None is the signal to exit
+            if func is None:
+                break
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                result = func(*args)
+            except Exception as err:
+                future.set_exception(err)
+            else:
+                future.set_result(result)
+
+    def _submit(self, func, *args):
+        '''
+            Queue a function call for the display thread.
+        '''
+        future = concurrent.futures.Future()
+        self._queue.put((func, args, future))
+
+        return future
+
+    def _present(self, im):
+        '''
+            Present a texture or an image and return the time of present.
+        '''
+        if isinstance(im, np.ndarray):
+            self.display._copy_to_data(im)
+            self.display.render()
+        else:
+            self.display.render(im)
+
+        return time.perf_counter()
+
+    def present(self, im):
+        '''
+            Queue a texture or an image for presentation.
+
+            Inputs:
+                im: Texture, or image of same size as screen. An image must
+                    not be modified till the future is done.
+
+            Outputs:
+                future: Future which resolves to the time (time.perf_counter)
+                    at which the image was presented
+        '''
+        return self._submit(self._present, im)
+
+    def create_texture_from_numpy(self, im):
+        '''
+            Queue creation of a texture. Returns a future of the texture.
+        '''
+        return self._submit(self.display.create_texture_from_numpy, im)
+
+    def preload(self, imstack, axis=2, chunk_size=32):
+        '''
+            Queue creation of textures from a stack. Returns a future of the
+            list of textures. See Display.create_textures_from_stack.
+        '''
+        return self._submit(self.display.create_textures_from_stack, imstack,
+                            axis, chunk_size)
+
+    def destroy(self, textures):
+        '''
+            Queue destruction of a list of textures. Returns a future.
+        '''
+        return self._submit(self.display.destroy_textures, textures)
+
+    def play_sequence(self, textures, frames_per_pattern=1, on_present=None,
+                      channels=None):
+        '''
+            Queue a sequence of textures. Returns a future of the outputs of
+            Display.play_sequence. on_present is called from the display
+            thread.
+        '''
+        return self._submit(self.display.play_sequence, textures,
+                            frames_per_pattern, on_present, channels)
+
+    def showData(self, im, key=None):
+        '''
+            Display a given image and wait till it is shown, same as
+            Display.showData.
+        '''
+        self._submit(self.display.showData, im, key).result()
+
+    def close(self):
+        '''
+            Close the display and stop the thread.
+        '''
+        future = self._submit(self.display.close)
+        self._queue.put((None, None, None))
+        future.result()
+        self._thread.join()
+
+# Record of a streamed frame. buffer belongs to the stream's pool and must be
+# handed back with FrameStream.release once the consumer is done with it.
+StreamFrame = collections.namedtuple('StreamFrame',
+                                     ['frame_index', 'timestamp', 'buffer'])
+
+class FrameStream(object):
+    '''
+        Producer thread that copies camera frames into a pool of
+        preallocated buffers and publishes them as StreamFrame records
+        through a bounded queue, so consumers can process a frame while the
+        next exposure runs.
+
+        The camera side is a grab function, grab(buffer), which waits for
+        the next frame, copies it into buffer and returns a tuple of
+        (frame_index, timestamp), or None if there was no frame, such as
+        while stopping. A frame that was lost while copying it, such as an
+        overwritten or incomplete frame, is returned as (frame_index, None)
+        and counted as dropped. Frame indices are expected to increase by
+        one per exposed frame, and gaps are counted as dropped frames.
+    '''
+    def __init__(self, grab, shape, dtype=np.uint16, queue_depth=4,
+                 npool=None, block=False, abort=None):
+        '''
+            Start the producer thread.
+
+            Inputs:
+                grab: Function that grabs one frame into a buffer, see above
+                shape: Shape of a frame
+                dtype: Data type of a frame. Default is uint16
+                queue_depth: Maximum number of frames waiting in the queue
+                npool: Number of buffers in the pool. Default is
+                    queue_depth + 2, which lets consumers hold two frames
+                block: If True, the producer waits for the consumer when
+                    the queue is full or all buffers are in use. If False,
+                    the newest frame is dropped instead, so the camera never
+                    waits for python.
+                abort: Optional function to interrupt a blocked grab, called
+                    when the stream is stopped
+
+            Outputs:
+                None
+        '''
+        if npool is None:
+            npool = queue_depth + 2
+
+        self.shape = tuple(shape)
+        self.block = block
+        self.queue = queue.Queue(maxsize=queue_depth)
+
+        self._grab = grab
+        self._abort = abort
+
+        # Pool of free buffers, plus a scratch buffer for draining frames
+        # that are dropped when no buffer is free
+        self._free = queue.Queue()
+        for idx in range(npool):
+            self._free.put(np.zeros(self.shape, dtype=dtype))
+        self._scratch = np.zeros(self.shape, dtype=dtype)
+
+        # Statistics
+        self.nframes = 0            # Frames published
+        self.dropped = 0            # Frames lost in camera or queue
+        self._last_index = None
+
+        self._error = None
+        self._stop = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _get_buffer(self):
+        '''
+            Get a free buffer from the pool, or None if the stream is
+            stopped. Without blocking, the scratch buffer is returned when
+            the pool is empty.
+        '''
+        if not self.block:
+            try:
+                return self._free.get_nowait()
+            except queue.Empty:
+                return self._scratch
+
+        while not self._stop.is_set():
+            try:
+                return self._free.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+        return None
+
+    def _publish(self, frame):
+        '''
+            Put a frame in the queue. Returns False if it was dropped.
+        '''
+        if not self.block:
+            try:
+                self.queue.put_nowait(frame)
+                return True
+            except queue.Full:
+                return False
+
+        while not self._stop.is_set():
+            try:
+                self.queue.put(frame, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _run(self):
+        '''
+            Producer loop.
+        '''
+        while not self._stop.is_set():
+            buf = self._get_buffer()
+            if buf is None:
+                break
+
+            try:
+                result = self._grab(buf)
+            except Exception as err:
+                # Errors from an aborted wait are expected while stopping
+                if not self._stop.is_set():
+                    self._error = err
+                result = None
+
+            if result is None or self._stop.is_set():
+                if buf is not self._scratch:
+                    self._free.put(buf)
+                if self._error is not None:
+                    break
+                continue
+
+            frame_index, timestamp = result
+
+            # Account for frames lost by the camera
+            if self._last_index is not None:
+                self.dropped += max(0, frame_index - self._last_index - 1)
+            self._last_index = frame_index
+
+            # Frames lost while copying, or drained into the scratch buffer
+            if timestamp is None or buf is self._scratch:
+                self.dropped += 1
+                if buf is not self._scratch:
+                    self._free.put(buf)
+                continue
+
+            if self._publish(StreamFrame(frame_index, timestamp, buf)):
+                self.nframes += 1
+            else:
+                self.dropped += 1
+                self._free.put(buf)
+
+    def get(self, timeout=None):
+        '''
+            Get the next frame from the queue.
+
+            Inputs:
+                timeout: Time in seconds to wait for a frame. Default is to
+                    wait forever
+
+            Outputs:
+                frame: StreamFrame of (frame_index, timestamp, buffer). Pass
+                    it to release once the buffer is not needed anymore.
+        '''
+        if timeout is not None:
+            tend = time.perf_counter() + timeout
+
+        while True:
+            try:
+                return self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+            if self._error is not None:
+                raise self._error
+            if not self._thread.is_alive():
+                raise RuntimeError('Stream is stopped')
+            if timeout is not None and time.perf_counter() > tend:
+                raise queue.Empty
+
+    def release(self, frame):
+        '''
+            Hand a buffer back to the pool.
+
+            Inputs:
+                frame: StreamFrame returned by get, or its buffer
+
+            Outputs:
+                None
+        '''
+        if isinstance(frame, StreamFrame):
+            frame = frame.buffer
+        self._free.put(frame)
+
+    def stop(self):
+        '''
+            Stop the producer thread. Frames already in the queue can still
+            be read with get.
+        '''
+        self._stop.set()
+        if self._abort is not None:
+            self._abort()
+        self._thread.join()
+
+class DemosaicStream(object):
+    '''
+        Second stage for a FrameStream of raw RGGB Bayer frames, which
+        demosaics frames in a pool of worker threads into preallocated RGB
+        buffers. Frames come out in the order they were captured, as
+        StreamFrame records, and buffers are handed back with release just
+        like with FrameStream. Raw buffers are returned to the camera stream
+        as soon as a frame is demosaiced.
+    '''
+    def __init__(self, source, nworkers=2, npool=None):
+        '''
+            Start demosaicing frames of a stream.
+
+            Inputs:
+                source: FrameStream of H x W uint8 Bayer frames
+                nworkers: Number of worker threads. Default is 2
+                npool: Number of RGB buffers. Default is 2*nworkers + 2
+
+            Outputs:
+                None
+        '''
+        if npool is None:
+            npool = 2*nworkers + 2
+
+        self.source = source
+        self.shape = tuple(source.shape) + (3,)
+
+        self._free = queue.Queue()
+        for idx in range(npool):
+            self._free.put(np.zeros(self.shape, dtype=np.uint8))
+
+        # Futures in capture order
+        self._pending = queue.Queue()
+
+        # Each worker keeps its own scratch buffer
+        self._local = threading.local()
+        self._executor = concurrent.futures.ThreadPoolExecutor(nworkers)
+
+        self._error = None
+        self._stop = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def nframes(self):
+        return self.source.nframes
+
+    @property
+    def dropped(self):
+        return self.source.dropped
+
+    def _demosaic(self, frame, rgb):
+        '''
+            Demosaic a raw frame into an RGB buffer, in a worker thread.
+        '''
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None:
+            H, W = self.source.shape
+            scratch = np.zeros((4*H + 2, W + 2), dtype=np.uint16)
+            self._local.scratch = scratch
+
+        try:
+            utils.demosaic_bilinear(frame.buffer, rgb, scratch)
+        finally:
+            self.source.release(frame)
+
+        return StreamFrame(frame.frame_index, frame.timestamp, rgb)
+
+    def _run(self):
+        '''
+            Feed raw frames to the workers whenever an RGB buffer is free.
+        '''
+        while not self._stop.is_set():
+            try:
+                rgb = self._free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            frame = None
+            while frame is None and not self._stop.is_set():
+                try:
+                    frame = self.source.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+                except Exception as err:
+                    if not self._stop.is_set():
+                        self._error = err
+                    break
+
+            if frame is None:
+                self._free.put(rgb)
+                break
+
+            self._pending.put(self._executor.submit(self._demosaic, frame,
+                                                    rgb))
+
+    def get(self, timeout=None):
+        '''
+            Get the next demosaiced frame. Same as FrameStream.get.
+        '''
+        if timeout is not None:
+            tend = time.perf_counter() + timeout
+
+        while True:
+            try:
+                return self._pending.get(timeout=0.1).result()
+            except queue.Empty:
+                pass
+
+            if self._error is not None:
+                raise self._error
+            if not self._thread.is_alive():
+                raise RuntimeError('Stream is stopped')
+            if timeout is not None and time.perf_counter() > tend:
+                raise queue.Empty
+
+    def release(self, frame):
+        '''
+            Hand an RGB buffer back to the pool.
+        '''
+        if isinstance(frame, StreamFrame):
+            frame = frame.buffer
+        self._free.put(frame)
+
+    def stop(self):
+        '''
+            Stop the camera stream and the workers. Frames already
+            demosaiced can still be read with get.
+        '''
+        self._stop.set()
+        self.source.stop()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+class HCamera(object):
+    '''
+        Camera class wrapper for Hamamatsu camera. Uses DCAM API provided by
+        Hamamatsu folks. Thanks a lot!
+    '''
+    def __init__(self, cam_num=0, exposure_time=10, binning=1, mode=0,
+                 roi_pos=[0, 0], roi_size=[512, 512], waittime=5000,
+                 fast=False, bufsize=10):
+        '''
+            Initialize a Hamamatsu camera.
+
+            Inputs:
+                cam_num: Number of the camera. Default is 0
+                exposure_time: Integration time in milliseconds. Default is 10ms
+                binning: Number of pixels to bin. ORCA Flash 4.0 LT only
+                    supports 1, 2, 4.
+                mode: Camera capture mode. 0 is internal, 2 is external edge.
+                waittime: Waiting time before bailing out for a new frame
+                fast: If True, continuous acquisition into a persistent ring
+                    buffer is started in the beginning, and capture returns
+                    the frames that arrive after it is called.
+                bufsize: Number of frames in the ring buffer. Default is 10
+
+            Outputs: None
+        '''
+        self.id = cam_num
+        self.waittime = waittime
+        self.bufsize = bufsize       # Default of 10 suggested by Ciprian
+        self.fast = fast
+        self.trig_mode = mode
+        self.acquiring = False
+        self.stream = None
+
+        # Initialize camera
+        ncameras = dcampy.init()
+        if (ncameras < self.id+1):
+            raise IOError('Could not find the requested number of cameras')
+
+        # Open a new camera object
+        self._camera = dcampy.Camera()
+        self.verify(self._camera.open(self.id), 'Camera opening')
+
+        # Hardware timestamp and framestamp of the last frame read
+        self.frame_info = dcampy.FrameInfo()
+
+        # Set exposure type to delayed exposure
+        trigtype = dcamapi.DCAMPROPMODEVALUE.TRIGGER_GLOBALEXPOSURE__DELAYED
+        trigprop = dcamapi.DCAMIDPROP.TRIGGER_GLOBALEXPOSURE
+        self.verify(self._camera.setpropvalue(trigprop, trigtype),
+                    'Exposure type')
+
+        # Set exposure, binning, ROI and trigger in one go
+        self.configure(exposure_time, binning, roi_pos, roi_size, mode)
+
+        # If you set it to free running mode, then we are fine.
+        if self.fast:
+            self.start_acquisition(self.bufsize)
+
+    def verify(self, retval, dbg_string='Unknown error'):
+        '''
+            Tiny wrapper to raise error when DCAMAPI is used
+        '''
+        if retval == False:
+            raise AttributeError('DCAMAPI failed at %s'%dbg_string)
+
+    def configure(self, exposure_time=None, binning=None, roi_pos=None,
+                  roi_size=None, mode=None):
+        '''
+            Change camera settings in a single transaction. Settings that
+            are None or already set are skipped, and capture is stopped and
+            restarted at most once for the rest. Frame buffers are resized
+            if binning or ROI changed.
+
+            Inputs:
+                exposure_time: Integration time in milliseconds
+                binning: Number of pixels to bin. ORCA Flash 4.0 LT only
+                    supports 1, 2, 4.
+                roi_pos: [row, column] position of region of interest
+                roi_size: [rows, columns] size of region of interest
+                mode: Camera capture mode. 0 is internal, 1 is software,
+                    2 is external edge.
+
+            Outputs: None
+        '''
+        if self.stream is not None:
+            raise RuntimeError('Stop the stream before changing settings')
+
+        prop = dcamapi.DCAMIDPROP
+        modevalue = dcamapi.DCAMPROPMODEVALUE
+        props = []
+
+        if exposure_time is not None:
+            props.append((prop.EXPOSURETIME, exposure_time/1000.0))
+
+        if binning is not None:
+            if binning == 1:
+                prop_mode = modevalue.BINNING__1
+            elif binning == 2:
+                prop_mode = modevalue.BINNING__2
+            elif binning == 4:
+                prop_mode = modevalue.BINNING__4
+            else:
+                raise AttributeError('Binning option not defined')
+            props.append((prop.BINNING, prop_mode))
+
+        if roi_size is not None:
+            props.append((prop.SUBARRAYHSIZE, roi_size[1]))
+            props.append((prop.SUBARRAYVSIZE, roi_size[0]))
+            self.roi_size = roi_size
+
+        if roi_pos is not None:
+            props.append((prop.SUBARRAYHPOS, roi_pos[1]))
+            props.append((prop.SUBARRAYVPOS, roi_pos[0]))
+            self.roi_pos = roi_pos
+
+        # Do not forget to enable subarray mode
+        if roi_size is not None or roi_pos is not None:
+            props.append((prop.SUBARRAYMODE, modevalue.MODE__ON))
+
+        if mode is not None:
+            if mode == 0:
+                prop_mode = modevalue.TRIGGERSOURCE__INTERNAL
+            elif mode == 1:
+                prop_mode = modevalue.TRIGGERSOURCE__SOFTWARE
+            elif mode == 2:
+                prop_mode = modevalue.TRIGGERSOURCE__EXTERNAL
+            else:
+                raise AttributeError('Trigger option not defined')
+            props.append((prop.TRIGGERSOURCE, prop_mode))
+            self.trig_mode = mode
+
+        self.verify(self._camera.setpropvalues(props), 'Configure')
+
+        # Exposure time the camera actually uses, which may be clamped
+        self.exposure_time = 1000*self._camera.getpropvalue(
+                                            prop.EXPOSURETIME, cached=True)
+
+        # Get image dimensions
+        H = self._camera.getpropvalue(prop.IMAGE_HEIGHT)
+        W = self._camera.getpropvalue(prop.IMAGE_WIDTH)
+
+        size = [int(H), int(W)]
+        if getattr(self, 'size', None) != size:
+            self.size = size
+
+            # Buffer for copying single frames out of the ring buffer, and
+            # integer accumulator for averaging them
+            self._frame = np.zeros(self.size, dtype=np.uint16)
+            self._accum = utils.FrameAccumulator('sum', np.uint32,
+                                                 shape=self.size)
+
+    def set_exposure(self, exposure_time):
+        '''
+            Separate method for setting exposure time. Returns the exposure
+            time in milliseconds that the camera actually uses.
+        '''
+        self.configure(exposure_time=exposure_time)
+
+        return self.exposure_time
+
+    def fire_trigger(self):
+        '''
+            This function should have been defined in dcampy or dcamapi but it
+            is not. The idea is to fire a trigger for software-triggered
+            exposure.
+        '''
+        # The C++ definition is dcamcap_firetrigger(hdcam)
+        retval = dcamapi.firetrigger(self._camera._hdcam)
+        self.verify(retval, 'Fire trig')
+
+    def start_acquisition(self, depth=10):
+        '''
+            Start continuous acquisition into a persistent ring buffer.
+            Frames are numbered by a sequence number that starts at 0 and
+            keeps increasing, while frame k is stored in slot k%depth of the
+            ring buffer.
+
+            Inputs:
+                depth: Number of frames in the ring buffer. Default is 10.
+                    One slot is always being written by the camera, so at
+                    most depth-1 frames can be read back.
+
+            Outputs: None
+        '''
+        if self.acquiring:
+            raise RuntimeError('Acquisition already running')
+        if depth < 2:
+            raise ValueError('Ring buffer needs at least 2 frames')
+
+        self.verify(self._camera.preparecapture(dcamapi.CAP_START.SEQUENCE,
+                                                depth), 'Prepare capture')
+        self.verify(self._camera.startcapture(), 'Start capture')
+
+        self.ring_depth = depth
+        self.acquiring = True
+
+    def stop_acquisition(self):
+        '''
+            Stop continuous acquisition and release the ring buffer.
+        '''
+        if not self.acquiring:
+            return
+
+        self.verify(self._camera.stopcapture(), 'Stop capture')
+        self.verify(self._camera.unpreparecapture(), 'Unprepare capture')
+        self.acquiring = False
+
+    def frame_count(self):
+        '''
+            Get the number of frames captured since acquisition started,
+            which is also the sequence number of the next frame. Not
+            available while a stream is running, since the stream thread
+            owns the camera then.
+        '''
+        if self.stream is not None:
+            raise RuntimeError('Camera is used by the stream')
+        return self._camera.getcapturecount()
+
+    def _wait_frame(self, seq):
+        '''
+            Wait till frame with sequence number seq is captured, and check
+            that it is still in the ring buffer.
+        '''
+        count = self._camera.getcapturecount()
+        while count <= seq:
+            self.verify(self._camera.waitforframe(self.waittime), 'Waiting')
+            count = self._camera.getcapturecount()
+
+        # Once count reaches seq + depth, frame seq + depth is being
+        # transferred into the slot of frame seq
+        if count - seq >= self.ring_depth:
+            raise RuntimeError('Ring buffer overrun: frame %d was '
+                               'overwritten'%seq)
+
+    def _check_overrun(self, seq):
+        '''
+            Check that frame seq was not overwritten while it was read.
+        '''
+        if self._camera.getcapturecount() - seq >= self.ring_depth:
+            raise RuntimeError('Ring buffer overrun: frame %d was '
+                               'overwritten while reading'%seq)
+
+    def get_frames(self, start, nframes=1, out=None, info=None):
+        '''
+            Get frames from the ring buffer by sequence number, waiting for
+            frames that are not captured yet. To get the next N frames after
+            frame k, use start=k+1. Not available while a stream is running.
+
+            Inputs:
+                start: Sequence number of the first frame
+                nframes: Number of frames. Default is 1
+                out: Optional nframes x H x W uint16 array to copy frames to
+                info: Optional list of nframes dcampy.FrameInfo, filled with
+                    the hardware timestamp and framestamp of each frame.
+                    Consecutive framestamps differ by more than one if the
+                    camera lost frames in between.
+
+            Outputs:
+                out: nframes x H x W uint16 array of frames
         '''
-            Initialize a Hamamatsu camera.
+        if not self.acquiring:
+            raise RuntimeError('Acquisition is not running')
+        if self.stream is not None:
+            raise RuntimeError('Camera is used by the stream, use '
+                               'stream.get() instead')
+
+        if out is None:
+            out = np.zeros([nframes] + self.size, dtype=np.uint16)
+
+        for idx in range(nframes):
+            seq = start + idx
+            self._wait_frame(seq)
+            frame_info = self.frame_info if info is None else info[idx]
+            self.verify(self._camera.getframe_into(seq % self.ring_depth,
+                                                   out[idx],
+                                                   frame_info),
+                        'Get frame')
+            self._check_overrun(seq)
+
+        # Keep our own copy, so later captures do not write into info
+        if info is not None and nframes > 0:
+            self.frame_info = copy.copy(info[nframes-1])
+
+        return out
+
+    def start_stream(self, queue_depth=4, npool=None, block=False):
+        '''
+            Start a producer thread that copies every new frame into a pool
+            of buffers and publishes it in a bounded queue. Continuous
+            acquisition is started if it is not running already.
 
             Inputs:
-                cam_num: Number of the camera. Default is 0
-                exposure_time: Integration time in milliseconds. Default is 10ms
-                binning: Number of pixels to bin. ORCA Flash 4.0 LT only
-                    supports 1, 2, 4.
-                mode: Camera capture mode. 0 is internal, 2 is external edge.
-                waittime: Waiting time before bailing out for a new frame
-                fast: If True, image buffer is only created in the beginning.
-                    WARNING: fast may not work correctly.                
+                queue_depth: Maximum number of frames waiting in the queue
+                npool: Number of buffers in the pool. Default is
+                    queue_depth + 2
+                block: If True, the producer waits for a slow consumer, and
+                    frames are only lost if the ring buffer overruns. If
+                    False, frames are dropped when the queue is full.
 
-            Outputs: None
+            Outputs:
+                stream: FrameStream. Use stream.get() to get frames and
+                    stream.release(frame) to return their buffers. The
+                    frame_index and timestamp of each frame are the
+                    hardware framestamp and timestamp, so frames lost by
+                    the camera are counted as dropped as well.
         '''
-        self.id = cam_num
-        self.waittime = waittime
-        self.bufsize = 10            # Hard coded, suggested by Ciprian
-        self.fast = fast
-        self.trig_mode = mode
+        if self.stream is not None:
+            raise RuntimeError('Stream already running')
 
-        # Initialize camera
-        ncameras = dcampy.init()
-        if (ncameras < self.id+1):
-            raise IOError('Could not find the requested number of cameras')
+        self._stream_acquisition = not self.acquiring
+        if not self.acquiring:
+            self.start_acquisition(self.bufsize)
 
-        # Open a new camera object
-        self._camera = dcampy.Camera()
-        self.verify(self._camera.open(self.id), 'Camera opening')
+        self._stream_seq = self.frame_count()
+        self._stream_info = dcampy.FrameInfo()
+        self._stream_stop = threading.Event()
+        self.stream = FrameStream(self._grab_stream, self.size, np.uint16,
+                                  queue_depth, npool, block,
+                                  self._abort_stream)
 
-        # Set exposure
-        self.set_exposure(exposure_time)
+        return self.stream
 
-        # Set exposure type to delayed exposure
-        trigtype = dcamapi.DCAMPROPMODEVALUE.TRIGGER_GLOBALEXPOSURE__DELAYED
-        trigprop = dcamapi.DCAMIDPROP.TRIGGER_GLOBALEXPOSURE
-        self.verify(self._camera.setpropvalue(trigprop, trigtype),
-                    'Exposure type')
+    def stop_stream(self):
+        '''
+            Stop the producer thread, and stop acquisition if it was started
+            by start_stream.
 
-        # Set binning
-        if binning == 1:
-            prop_mode = dcamapi.DCAMPROPMODEVALUE.BINNING__1
-        elif binning == 2:
-            prop_mode = dcamapi.DCAMPROPMODEVALUE.BINNING__2
-        elif binning == 4:
-            prop_mode = dcamapi.DCAMPROPMODEVALUE.BINNING__4
-        self.verify(self._camera.setpropvalue(dcamapi.DCAMIDPROP.BINNING,
-                                              prop_mode), 'Binning')
-
-        #Set ROI
-        self.verify(self._camera.setpropvalue(dcamapi.DCAMIDPROP.SUBARRAYHSIZE,
-                                              roi_size[1]), 'ROI HSIZE')
-        self.verify(self._camera.setpropvalue(dcamapi.DCAMIDPROP.SUBARRAYVSIZE,
-                                              roi_size[0]), 'ROI VSIZE')
-        self.verify(self._camera.setpropvalue(dcamapi.DCAMIDPROP.SUBARRAYHPOS,
-                                              roi_pos[1]), 'ROI HPOS')
-        self.verify(self._camera.setpropvalue(dcamapi.DCAMIDPROP.SUBARRAYVPOS,
-                                              roi_pos[0]), 'ROI VPOS')
+            Outputs:
+                stream: The stopped FrameStream, with frames still queued
+        '''
+        stream = self.stream
+        if stream is None:
+            return None
 
-        # Do not forget to enable subarray mode
-        mode_on = dcamapi.DCAMPROPMODEVALUE.MODE__ON
-        self.verify(self._camera.setpropvalue(dcamapi.DCAMIDPROP.SUBARRAYMODE,
-                                              mode_on), 'ROI ON')
-        self.roi_pos = roi_pos
-        self.roi_size = roi_size
+        stream.stop()
+        self.stream = None
 
-        # Get image dimensions
-        H = self._camera.getpropvalue(dcamapi.DCAMIDPROP.IMAGE_HEIGHT)
-        W = self._camera.getpropvalue(dcamapi.DCAMIDPROP.IMAGE_WIDTH)
-
-        self.size = [H, W]
-
-        # Set trigger
-        if mode == 0:
-            mode = dcamapi.DCAMPROPMODEVALUE.TRIGGERSOURCE__INTERNAL
-        elif mode == 1:
-            mode = dcamapi.DCAMPROPMODEVALUE.TRIGGERSOURCE__SOFTWARE
-        elif mode == 2:
-            mode = dcamapi.DCAMPROPMODEVALUE.TRIGGERSOURCE__EXTERNAL
-        else:
-            raise AttributeError('Trigger option not defined')
+        if self._stream_acquisition:
+            self.stop_acquisition()
 
-        self.verify(self._camera.setpropvalue(
-                dcamapi.DCAMIDPROP.TRIGGERSOURCE, mode), 'Trigger set')
+        return stream
 
-        # If you set it to free running mode, then we are fine.
-        if self.fast:
-            self.verify(self._camera.preparecapture(-1, self.bufsize),
-                        'Prepare capture')
-            self.verify(self._camera.startcapture(), 'Start capture')
+    def _abort_stream(self):
+        '''
+            Stop the grab function of the stream, interrupting its wait.
+        '''
+        self._stream_stop.set()
+        self._camera.abortwait()
 
-    def verify(self, retval, dbg_string='Unknown error'):
+    def _grab_stream(self, buf):
         '''
-            Tiny wrapper to raise error when DCAMAPI is used
+            Grab function of the stream. Copies the next frame into buf and
+            returns its hardware framestamp and timestamp. The timestamp is
+            None if the frame was overwritten while copying. Waits through
+            timeouts, such as with a slow external trigger, till the stream
+            is stopped.
         '''
-        if retval == False:
-            raise AttributeError('DCAMAPI failed at %s'%dbg_string)
+        seq = self._stream_seq
+        count = self._camera.getcapturecount()
+        while count <= seq:
+            if self._stream_stop.is_set():
+                return None
+            if not self._camera.waitforframe(self.waittime):
+                if self._stream_stop.is_set():
+                    return None
+                if self._camera.waiterror != dcampy.ERR_TIMEOUT:
+                    raise AttributeError('DCAMAPI failed at Waiting')
+            count = self._camera.getcapturecount()
+
+        # Skip frames that were already overwritten in the ring buffer, and
+        # the slot that is being written
+        seq = max(seq, count - self.ring_depth + 1)
+        self._stream_seq = seq + 1
+
+        self.verify(self._camera.getframe_into(seq % self.ring_depth, buf,
+                                               self._stream_info),
+                    'Get frame')
+
+        # Frame was overwritten while copying, so it counts as dropped
+        if self._camera.getcapturecount() - seq >= self.ring_depth:
+            return self._stream_info.framestamp, None
+
+        return self._stream_info.framestamp, self._stream_info.timestamp
+
+    def capture_burst(self, n_frames, out=None, info=None):
+        '''
+            Capture a burst of frames with a single prepare. The camera is
+            armed once, and frames are collected as frame-ready events
+            arrive, so with an external trigger (mode=2) the time between
+            frames is only limited by readout. If continuous acquisition is
+            already running, the next n_frames frames are returned instead.
 
-    def set_exposure(self, exposure_time):
+            Inputs:
+                n_frames: Number of frames to capture
+                out: Optional n_frames x H x W uint16 array for the frames
+                info: Optional list of n_frames dcampy.FrameInfo for the
+                    hardware stamps of frames
+
+            Outputs:
+                out: n_frames x H x W uint16 array of frames
         '''
-            Separate method for setting exposure time.
+        if self.stream is not None:
+            raise RuntimeError('Camera is streaming, get frames from the '
+                               'stream instead')
+
+        if out is None:
+            out = np.zeros([n_frames] + self.size, dtype=np.uint16)
+        elif out.shape != tuple([n_frames] + self.size) or \
+                out.dtype != np.uint16:
+            raise ValueError('Output should be a %d x %d x %d uint16 '
+                             'array'%tuple([n_frames] + self.size))
+
+        if self.acquiring:
+            return self.get_frames(self.frame_count(), n_frames, out, info)
+
+        # Frames are copied out as they arrive, so the ring buffer does not
+        # need to hold the whole burst
+        self.start_acquisition(min(n_frames + 1, max(self.bufsize, 2)))
+        try:
+            self.get_frames(0, n_frames, out, info)
+        finally:
+            self.stop_acquisition()
+
+        return out
+
+    def record(self, filename, nframes, dcimg=False):
         '''
-        self.verify(self._camera.setpropvalue(dcamapi.DCAMIDPROP.EXPOSURETIME,
-                                              exposure_time/1000.0),
-                    'Exposure time')
+            Record frames at the full frame rate straight to disk.
 
-    def fire_trigger(self):
+            By default, frames are copied from the ring buffer into a
+            preallocated memory-mapped .npy file, and the hardware stamps
+            of frames are saved next to it. Read it back with
+            utils.load_recording. Use a large bufsize at high frame rates so
+            that the ring buffer does not overrun while pages are flushed.
+
+            With dcimg=True, the DCAM recorder writes a .dcimg file instead,
+            which needs Hamamatsu's tools to read.
+
+            Inputs:
+                filename: Name of the file to record to
+                nframes: Number of frames to record
+                dcimg: If True, use the DCAM recorder. Default is False
+
+            Outputs:
+                frames: nframes x H x W memmap of the recorded frames, or
+                    the number of frames recorded with dcimg=True
         '''
-            This function should have been defined in dcampy or dcamapi but it
-            is not. The idea is to fire a trigger for software-triggered
-            exposure.
+        if self.stream is not None:
+            raise RuntimeError('Stop the stream before recording')
+
+        if dcimg:
+            return self._record_dcimg(filename, nframes)
+
+        frames = utils.create_recording(filename, nframes, self.size,
+                                        np.uint16)
+        info = [dcampy.FrameInfo() for idx in range(nframes)]
+
+        started = not self.acquiring
+        if started:
+            self.start_acquisition(self.bufsize)
+
+        try:
+            self.get_frames(self.frame_count(), nframes, frames, info)
+        finally:
+            if started:
+                self.stop_acquisition()
+            frames.flush()
+
+        utils.save_recording_stamps(filename,
+                                    [item.framestamp for item in info],
+                                    [item.timestamp for item in info])
+
+        return frames
+
+    def _record_dcimg(self, filename, nframes):
         '''
-        # The C++ definition is dcamcap_firetrigger(hdcam)
-        retval = dcamapi.firetrigger(self._camera._hdcam)
-        self.verify(retval, 'Fire trig')
+            Record frames with the DCAM recorder. The recorder has to be
+            attached before capture starts, so continuous acquisition is
+            stopped for the duration of the recording.
+        '''
+        restart = self.acquiring
+        self.stop_acquisition()
 
-    def capture(self, navg=1):
+        self.verify(self._camera.preparecapture(dcamapi.CAP_START.SEQUENCE,
+                                                self.bufsize),
+                    'Prepare capture')
+        self.verify(self._camera.startrecorder(filename, nframes),
+                    'Start recorder')
+        self.verify(self._camera.startcapture(), 'Start capture')
+
+        try:
+            count = self._camera.getrecorderframecount()
+            while count < nframes:
+                self.verify(self._camera.waitforframe(self.waittime),
+                            'Waiting')
+                count = self._camera.getrecorderframecount()
+        finally:
+            self._camera.stopcapture()
+            self._camera.stoprecorder()
+            self._camera.unpreparecapture()
+
+            if restart:
+                self.start_acquisition(self.ring_depth)
+
+        return count
+
+    def capture(self, navg=1, accumulator=None):
         '''
             Capture a single images.
 
             Inputs:
                 navg: Number of images to average
+                accumulator: Optional utils.FrameAccumulator to average
+                    with, such as one in 'welford' or 'sigmaclip' mode.
+                    Default is an integer sum.
 
             Outputs:
                 img: Captured and averaged images
         '''
-        img_accum = 0
+        if self.stream is not None:
+            raise RuntimeError('Camera is streaming, get frames from the '
+                               'stream instead')
+
+        if accumulator is None:
+            accumulator = self._accum
+        accumulator.reset()
+
+        # With continuous acquisition running, either in fast mode or after
+        # start_acquisition, average frames that arrive after this call
+        if self.acquiring:
+            start = self.frame_count()
+            for idx in range(navg):
+                self.get_frames(start + idx, 1, self._frame[np.newaxis])
+                accumulator.add(self._frame)
+
+            return accumulator.mean()
 
         # If not in fast mode, prepare and start capture
-        if not self.fast:
-            self.verify(self._camera.preparecapture(-1, navg),
-                        'Prepare capture')
-            self.verify(self._camera.startcapture(), 'Start capture')
+        self.verify(self._camera.preparecapture(dcamapi.CAP_START.SEQUENCE,
+                                                navg), 'Prepare capture')
+        self.verify(self._camera.startcapture(), 'Start capture')
+
         for idx in range(navg):
             self.verify(self._camera.waitforframe(self.waittime), 'Waiting')
-            buf = self._camera.getframe(self._camera.getcaptureindex())
-            #buf = self._camera.getframe(-1)
-            img_accum += buf.astype(np.float32)
+            self.verify(self._camera.getframe_into(
+                            self._camera.getcaptureindex(), self._frame,
+                            self.frame_info),
+                        'Get frame')
+            accumulator.add(self._frame)
 
-        if not self.fast:
-            self.verify(self._camera.stopcapture(), 'Stop capture')
-            self.verify(self._camera.unpreparecapture(), 'Unprepare capture')
+        self.verify(self._camera.stopcapture(), 'Stop capture')
+        self.verify(self._camera.unpreparecapture(), 'Unprepare capture')
 
-        img_accum = img_accum/navg
-
-        return img_accum
+        return accumulator.mean()
     
     def close(self):
         '''
             Safely shutdown the camera.
         '''
-        # If in fast mode, stop capture now
-        if self.fast:
-            self.verify(self._camera.stopcapture(), 'Stop capture')
-            self.verify(self._camera.unpreparecapture(), 'Unprepare capture')
+        # If streaming or acquiring continuously, stop capture now
+        self.stop_stream()
+        self.stop_acquisition()
             
         self.verify(self._camera.close(), 'Close camera')
         dcampy.uninit()
 
+# Chunk data of a Spinnaker image. timestamp is camera time in seconds, and
+# exposure_time is in milliseconds (None if chunk data is not enabled).
+ChunkInfo = collections.namedtuple('ChunkInfo',
+                                   ['frame_id', 'timestamp', 'exposure_time'])
+
+class CameraError(SystemError):
+    '''
+        Raised when a camera fails to deliver an image, such as on a
+        timeout or a driver error.
+    '''
+    pass
+
 class SPCamera(object):
     '''
         Create a class to handle Spinnaker (ptgrey) cameras.
@@ -560,13 +2287,30 @@ class SPCamera(object):
             exposure_time: Exposure time in ms
             gain: Gain in dB
             trig_pin: Trigger pin. Set to -1 (default) to disable trigger
+            waittime: Time in milliseconds to wait for an image before
+                raising CameraError. Default is 5000
+            buffer_count: Number of stream buffers in the host. Default
+                (None) leaves the driver setting
+            buffer_mode: Stream buffer handling mode, one of 'NewestOnly',
+                'OldestFirst' or 'OldestFirstOverwrite'. Default (None)
+                leaves the driver setting
+            demosaic_workers: With isrgb=True and israw=False, a value
+                above 0 makes the camera send raw BayerRG8 images, which
+                are demosaiced on the host with utils.demosaic_bilinear
+                instead of Spinnaker's conversion. A stream demosaics with
+                this many worker threads. Default is 0
 
         Outputs:
             None
     '''
+    # Stream buffer handling modes, see set_stream_buffers
+    BUFFER_MODES = ['NewestOnly', 'OldestFirst', 'OldestFirstOverwrite']
+
     def __init__(self, cam_id=0, exposure_time=10, binning=1,
                  trig_pin=-1, roi_pos=[-1, -1], roi_size=[0, 0],
-                 fast=True, gain=0, debug=False, isrgb=False, israw=False):
+                 fast=True, gain=0, debug=False, isrgb=False, israw=False,
+                 waittime=5000, buffer_count=None, buffer_mode=None,
+                 demosaic_workers=0):
         # The option fast=True is just to make the SPCamera compatible with
         # HCamera.
         
@@ -574,6 +2318,20 @@ class SPCamera(object):
         self.debug = debug
         self.isrgb = isrgb
         self.israw = israw
+        self.waittime = waittime
+        self.stream = None
+
+        # Demosaic raw images on the host
+        self.demosaic_workers = demosaic_workers if (isrgb and not israw) \
+                                else 0
+        self._demosaic_scratch = None
+
+        # Cached node handles, and last stream buffer settings written
+        self._nodes = {}
+        self._values = {}
+
+        # Integer accumulator for averaging frames
+        self._accum = utils.FrameAccumulator('sum', np.uint32)
         
         if debug:
             print('\tInitializing PySpin system')   
@@ -616,17 +2374,10 @@ class SPCamera(object):
 
         self._cam.GainAuto.SetValue(PySpin.GainAuto_Off)
 
-        if self._cam.Gain.GetAccessMode() != PySpin.RW:
-            raise ValueError('Cannot set gain. Bailing out.')
-
-        self._cam.Gain.SetValue(gain)
-
         # Finally, configure trigger mode
         # Need nodemap for this
         if debug:
             print('\tSetting trigger')
-        nodemap = self._cam.GetNodeMap()
-
         # Rely on QuickSpin settings
         if self._cam.TriggerSource.GetAccessMode() != PySpin.RW:
             raise AttributeError('Cannot control trigger.')
@@ -652,7 +2403,7 @@ class SPCamera(object):
             print('\tDisabling auto frame rate')
 
         af_str = 'AcquisitionFrameRateEnabled'
-        autoframe_mode = PySpin.CBooleanPtr(nodemap.GetNode(af_str))
+        autoframe_mode = PySpin.CBooleanPtr(self._node(af_str))
 
         if not PySpin.IsAvailable(autoframe_mode):
             print('autoframe feature does not exist')
@@ -670,7 +2421,7 @@ class SPCamera(object):
             print('\tDisabling black level')
 
         bl_str = 'BlackLevelEnabled'
-        blacklevel_mode = PySpin.CBooleanPtr(nodemap.GetNode(bl_str))
+        blacklevel_mode = PySpin.CBooleanPtr(self._node(bl_str))
 
         if not PySpin.IsAvailable(blacklevel_mode) or not (
             PySpin.IsReadable(blacklevel_mode)):
@@ -686,21 +2437,15 @@ class SPCamera(object):
 
         self._cam.ExposureAuto.SetValue(PySpin.ExposureAuto_Off)
 
-        if self._cam.ExposureTime.GetAccessMode() != PySpin.RW:
-            raise AttributeError('Unable to set exposure time. Bailing out.')
-
-        self._cam.ExposureTime.SetValue(exposure_time*1000)
-
-        # Start continuous acquisition
+        # Attach frame ID, timestamp and exposure time to every image
         if debug:
-            print('\tStarting acquisition')
-        self._cam.BeginAcquisition()
-
-        # Set pixel format to Mono 16
-        self._cam.EndAcquisition()
+            print('\tEnabling chunk data')
+        self.chunk_data = self._enable_chunk_data()
+        self.frame_info = None
 
+        # Set pixel format
         if self.isrgb:
-            if self.israw:
+            if self.israw or self.demosaic_workers > 0:
                 pixformat = PySpin.PixelFormat_BayerRG8
             else:
                 pixformat = PySpin.PixelFormat_RGB8Packed
@@ -741,53 +2486,405 @@ class SPCamera(object):
             else:
                 print('\tCannot set white balance ratio for red channel')
 
+        # Set exposure, gain, binning, ROI and stream buffers, and then
+        # start continuous acquisition
+        self.roi_size = [0, 0]
+        self.roi_pos = [-1, -1]
+        self.configure(exposure_time=exposure_time, gain=gain,
+                       binning=binning, roi_size=roi_size, roi_pos=roi_pos,
+                       buffer_count=buffer_count, buffer_mode=buffer_mode)
+
+        if debug:
+            print('\tStarting acquisition')
         self._cam.BeginAcquisition()
 
-        # Set binning
-        self.set_binning(binning)
+    def _enable_chunk_data(self):
+        '''
+            Enable chunk data for frame ID, timestamp and exposure time.
+            Returns False if the camera does not support it.
+        '''
+        if self._cam.ChunkModeActive.GetAccessMode() != PySpin.RW:
+            print('\tCannot enable chunk data')
+            return False
+
+        self._cam.ChunkModeActive.SetValue(True)
+
+        for selector in [PySpin.ChunkSelector_FrameID,
+                         PySpin.ChunkSelector_Timestamp,
+                         PySpin.ChunkSelector_ExposureTime]:
+            self._cam.ChunkSelector.SetValue(selector)
+            if self._cam.ChunkEnable.GetAccessMode() != PySpin.RW:
+                print('\tCannot enable chunk data')
+                self._cam.ChunkModeActive.SetValue(False)
+                return False
+            self._cam.ChunkEnable.SetValue(True)
+
+        return True
+
+    def _image_info(self, img):
+        '''
+            Get ChunkInfo of an image. Without chunk data, the frame ID and
+            timestamp are taken from the image itself.
+        '''
+        if self.chunk_data:
+            chunk = img.GetChunkData()
+            return ChunkInfo(chunk.GetFrameID(), chunk.GetTimestamp()*1e-9,
+                             chunk.GetExposureTime()/1000.0)
+
+        return ChunkInfo(img.GetFrameID(), img.GetTimeStamp()*1e-9, None)
+
+    def camera_time(self):
+        '''
+            Get the current time of the camera clock in seconds, which is
+            the clock of image timestamps. Pass it as after to capture to
+            only accept images exposed after this call.
+        '''
+        self._node('TimestampLatch').Execute()
+
+        return self._node('TimestampLatchValue').GetValue()*1e-9
+
+    def _node(self, name):
+        '''
+            Get a node by name, looking it up only once.
+        '''
+        node = self._nodes.get(name)
+        if node is None:
+            if hasattr(self._cam, name):
+                node = getattr(self._cam, name)
+            else:
+                node = self._cam.GetNodeMap().GetNode(name)
+            self._nodes[name] = node
+
+        return node
+
+    def _roi_writes(self, roi_size, roi_offset, binning):
+        '''
+            Node writes for a region of interest at a given binning.
+        '''
+        # WidthMax and HeightMax are for the current binning, and can be
+        # smaller than the sensor
+        Hmax = PySpin.CIntegerPtr(self._node('HeightMax')).GetValue()
+        Wmax = PySpin.CIntegerPtr(self._node('WidthMax')).GetValue()
+        Hmax = Hmax*self._node('BinningVertical').GetValue()//binning
+        Wmax = Wmax*self._node('BinningHorizontal').GetValue()//binning
+
+        H, W = roi_size
+        Ho, Wo = roi_offset
+
+        # If any entry of roi_size is 0, set roi size to maximum
+        if (H == 0) or (W == 0):
+            H = Hmax
+            W = Wmax
+
+        # If any entry of offset is -1, center the ROI
+        if (Ho < 0) or (Wo < 0):
+            Ho = 4 * ((Hmax - H)//8)
+            Wo = 4 * ((Wmax - W)//8)
+
+        if ((H + Ho) > Hmax) or ((W + Wo) > Wmax):
+            raise ValueError('ROI configuration is wrong')
+
+        # Offsets are cleared first so that the new size always fits
+        return [('OffsetX', 0), ('OffsetY', 0), ('Width', W), ('Height', H),
+                ('OffsetX', Wo), ('OffsetY', Ho)]
+
+    def configure(self, **settings):
+        '''
+            Change several settings in a single transaction. All settings
+            are validated before anything is changed, values that are
+            already set are skipped, and acquisition is stopped and
+            restarted at most once.
+
+            Inputs:
+                settings: Any of the following. Settings that are None are
+                    skipped.
+                    exposure_time: Exposure time in ms
+                    gain: Gain in dB
+                    binning: Number of pixels to bin
+                    roi_size: 2-tuple with Height and width of region of
+                        interest. If any entry is 0, the full sensor is used
+                    roi_pos: 2-tuple of top left corner of ROI. If any
+                        entry is -1, roi is centered.
+                    buffer_count: Number of stream buffers
+                    buffer_mode: Stream buffer handling mode, see
+                        set_stream_buffers
+
+            Outputs:
+                None
+
+            WARNING: ROI size and offset have to respect binning
+        '''
+        names = ['exposure_time', 'gain', 'binning', 'roi_size', 'roi_pos',
+                 'buffer_count', 'buffer_mode']
+        for name in settings:
+            if name not in names:
+                raise ValueError('Unknown setting %s'%name)
+
+        settings = {name: value for name, value in settings.items()
+                    if value is not None}
+
+        if self.stream is not None:
+            raise RuntimeError('Stop the stream before changing settings')
+
+        if settings.get('buffer_mode', self.BUFFER_MODES[0]) \
+                not in self.BUFFER_MODES:
+            raise ValueError('Buffer handling mode %s is not '
+                             'supported'%settings['buffer_mode'])
+
+        # Writes that can be done while acquiring
+        live = []
+        if 'exposure_time' in settings:
+            live.append(('ExposureTime', settings['exposure_time']*1000))
+        if 'gain' in settings:
+            live.append(('Gain', settings['gain']))
+
+        # Writes that need acquisition to be stopped
+        binning_writes = []
+        if 'binning' in settings:
+            binning = settings['binning']
+            binning_writes = [('BinningVertical', binning),
+                              ('BinningHorizontal', binning)]
+        else:
+            binning = self._node('BinningVertical').GetValue()
+
+        roi = []
+        if 'roi_size' in settings or 'roi_pos' in settings:
+            roi_size = settings.get('roi_size', self.roi_size)
+            roi_pos = settings.get('roi_pos', self.roi_pos)
+            roi = self._roi_writes(roi_size, roi_pos, binning)
+
+        # Validate all nodes before changing anything
+        for name, value in live + binning_writes + roi:
+            if not PySpin.IsAvailable(self._node(name)):
+                raise AttributeError('Camera does not support %s'%name)
+
+        # Skip values the camera already has. The camera clamps the ROI
+        # when binning changes, so compare with the nodes and not with what
+        # was written last.
+        live = [(name, value) for name, value in live
+                if self._node(name).GetValue() != value]
+        stopped = [(name, value) for name, value in binning_writes
+                   if self._node(name).GetValue() != value]
+        if roi and (stopped or any(self._node(name).GetValue() != value
+                                   for name, value in roi[2:])):
+            stopped += roi
+
+        if roi:
+            self.roi_size = roi_size
+            self.roi_pos = roi_pos
+
+        buffers = {}
+        for name in ['buffer_count', 'buffer_mode']:
+            if name in settings and \
+                    self._values.get(name) != settings[name]:
+                buffers[name] = settings[name]
+
+        for name, value in live:
+            if not PySpin.IsWritable(self._node(name)):
+                raise AttributeError('Cannot set %s'%name)
+
+        for name, value in live:
+            self._node(name).SetValue(value)
+
+        if len(stopped) == 0 and len(buffers) == 0:
+            return
+
+        # Apply everything else in one stop/start window
+        restart = self._cam.IsStreaming()
+        if restart:
+            self._cam.EndAcquisition()
+
+        try:
+            for name, value in stopped:
+                if not PySpin.IsWritable(self._node(name)):
+                    raise AttributeError('Cannot set %s'%name)
+
+            for name, value in stopped:
+                self._node(name).SetValue(value)
 
-        # Set region of interest
-        self.set_roi(roi_size, roi_pos)
+            self._set_stream_buffers(buffers.get('buffer_count'),
+                                     buffers.get('buffer_mode'))
+            self._values.update(buffers)
+        finally:
+            if restart:
+                self._cam.BeginAcquisition()
 
     def set_binning(self, binning=1):
         '''
             Set binning
         '''
-        # Stop acquisition before changing binning
-        self._cam.EndAcquisition()
-        if self._cam.BinningVertical.GetAccessMode() == PySpin.RW:
-            self._cam.BinningVertical.SetValue(binning)
-        else:
-            print('\tCannot change vertical binning')
+        self.configure(binning=binning)
 
-        if self._cam.BinningHorizontal.GetAccessMode() == PySpin.RW:
-            self._cam.BinningHorizontal.SetValue(binning)
-        else:
-            print('\tCannot change horizontal binning')
+    def _set_stream_buffers(self, count=None, mode=None):
+        '''
+            Set stream buffer count and handling mode. Acquisition has to
+            be stopped.
+        '''
+        stream = self._cam.TLStream
 
-        # Then restart acquisition
-        self._cam.BeginAcquisition()
+        if mode is not None:
+            if mode not in self.BUFFER_MODES:
+                raise ValueError('Buffer handling mode %s is not '
+                                 'supported'%mode)
 
-    def set_exposure(self, exposure_time=16.5):
+            if stream.StreamBufferHandlingMode.GetAccessMode() != PySpin.RW:
+                raise AttributeError('Cannot set buffer handling mode')
+            stream.StreamBufferHandlingMode.SetValue(
+                    getattr(PySpin, 'StreamBufferHandlingMode_%s'%mode))
+
+        if count is not None:
+            if stream.StreamBufferCountMode.GetAccessMode() != PySpin.RW:
+                raise AttributeError('Cannot set buffer count mode')
+            stream.StreamBufferCountMode.SetValue(
+                                    PySpin.StreamBufferCountMode_Manual)
+
+            if stream.StreamBufferCountManual.GetAccessMode() != PySpin.RW:
+                raise AttributeError('Cannot set buffer count')
+            stream.StreamBufferCountManual.SetValue(count)
+
+    def set_stream_buffers(self, count=None, mode=None):
         '''
-            Set exposure time on the fly.
+            Change the stream buffers of the host.
 
             Inputs:
-                exposure_time: Exposure time in ms
+                count: Number of buffers. None leaves it unchanged
+                mode: Buffer handling mode. 'NewestOnly' always returns the
+                    latest image, 'OldestFirst' returns images in order and
+                    stops filling buffers when all are full, and
+                    'OldestFirstOverwrite' returns images in order and
+                    overwrites the oldest when full. None leaves it
+                    unchanged.
+
+            Outputs:
+                None
         '''
-        if self._cam.ExposureAuto.GetAccessMode() != PySpin.RW:
-            raise AttributeError('Cannot configure exposure.')
+        self.configure(buffer_count=count, buffer_mode=mode)
 
-        self._cam.ExposureAuto.SetValue(PySpin.ExposureAuto_Off)
+    def start_stream(self, queue_depth=4, npool=None, block=False):
+        '''
+            Start a thread that captures images into a pool of buffers and
+            publishes them in a bounded queue. With a software trigger, the
+            thread triggers the next image as soon as one is read.
+
+            Inputs:
+                queue_depth: Maximum number of images waiting in the queue
+                npool: Number of buffers in the pool. Default is
+                    queue_depth + 2
+                block: If True, the thread waits for a slow consumer. If
+                    False, images are dropped when the queue is full.
+
+            Outputs:
+                stream: FrameStream, or DemosaicStream when demosaicing on
+                    the host. Use stream.get() to get
+                    (frame_id, timestamp, array) records and
+                    stream.release(frame) to return their buffers.
+                    Timestamps are camera times in seconds.
+        '''
+        if self.stream is not None:
+            raise RuntimeError('Stream already running')
+
+        shape = [self._cam.Height.GetValue(), self._cam.Width.GetValue()]
+        if self.isrgb and not self.israw and self.demosaic_workers == 0:
+            shape.append(3)
+
+        self._stream_stop = threading.Event()
+        self._stream_pending = False
+        self.stream = FrameStream(self._grab_stream, shape, np.uint8,
+                                  queue_depth, npool, block,
+                                  self._stream_stop.set)
+
+        # Raw images are demosaiced in worker threads, in order
+        if self.demosaic_workers > 0:
+            self.stream = DemosaicStream(self.stream, self.demosaic_workers)
+
+        return self.stream
+
+    def stop_stream(self):
+        '''
+            Stop the acquisition thread, and release images left in the
+            stream buffers so that the next capture gets a new image.
+
+            Outputs:
+                stream: The stopped FrameStream, with images still queued
+        '''
+        stream = self.stream
+        if stream is None:
+            return None
+
+        stream.stop()
+        self.stream = None
+
+        # An image that was triggered but not read yet is still on its way
+        self._flush_images(self._stream_pending)
+
+        return stream
+
+    def _flush_images(self, wait=False):
+        '''
+            Release all images waiting in the stream buffers. With
+            wait=True, the first image is waited for up to waittime.
+        '''
+        # A free running camera keeps delivering images, so flush at most
+        # as many as the stream buffers hold. Spinnaker's default is 10.
+        nbuffers = max(self._values.get('buffer_count', 0), 10)
+
+        timeout = self.waittime if wait else 0
+        for idx in range(nbuffers + 1):
+            try:
+                img = self._cam.GetNextImage(timeout)
+            except PySpin.SpinnakerException:
+                return
+
+            img.Release()
+            timeout = 0
+
+    def _grab_stream(self, buf):
+        '''
+            Grab function of the stream. Waits in short steps so that the
+            stream can be stopped, and keeps waiting through timeouts till
+            it is. Incomplete images are returned with a timestamp of None,
+            so they are counted as dropped.
+        '''
+        if self.software_trigger:
+            self._cam.TriggerSoftware.Execute()
+            self._stream_pending = True
+
+        while True:
+            try:
+                img = self._cam.GetNextImage(100)
+                self._stream_pending = False
+                break
+            except PySpin.SpinnakerException as err:
+                if self._stream_stop.is_set():
+                    return None
+                # Keep waiting through timeouts, such as with a slow
+                # external trigger
+                if err.errorcode != PySpin.SPINNAKER_ERR_TIMEOUT:
+                    raise CameraError('Could not get image: %s'%err) from err
 
-        if self._cam.ExposureTime.GetAccessMode() != PySpin.RW:
-            raise AttributeError('Unable to set exposure time.')
+        try:
+            # Incomplete frames are counted as dropped
+            if img.IsIncomplete():
+                return img.GetFrameID(), None
+
+            np.copyto(buf, self._image_view(img))
+            info = self._image_info(img)
+            return info.frame_id, info.timestamp
+        finally:
+            img.Release()
+
+    def set_exposure(self, exposure_time=16.5):
+        '''
+            Set exposure time on the fly.
 
-        self._cam.ExposureTime.SetValue(exposure_time*1000)
+            Inputs:
+                exposure_time: Exposure time in ms
+        '''
+        self.configure(exposure_time=exposure_time)
 
     def set_roi(self, roi_size, roi_offset=[-1, -1]):
         '''
-            Change region of interest, and binning.
+            Change region of interest.
 
             Inputs:
                 roi_size: 2-tuple with Height and width of region of interest
@@ -796,98 +2893,144 @@ class SPCamera(object):
 
             WARNING: ROI size and offset have to respect binning
         '''
-        # Stop acquisition before changing ROI configuration
-        self._cam.EndAcquisition()
-        
-        Hmax = self._cam.Height.GetMax()
-        Wmax = self._cam.Width.GetMax()
+        self.configure(roi_size=roi_size, roi_pos=roi_offset)
 
-        H, W = roi_size
-        Ho, Wo = roi_offset
+    def _next_image(self, after=None):
+        '''
+            Trigger if needed and wait for the next complete image.
+            Incomplete images are released and retried a few times, and so
+            are images with a timestamp before after.
 
-        # If any entry of roi_size is 0, set roi size to maximum
-        if (H == 0) or (W == 0):
-            H = Hmax
-            W = Wmax
+            Outputs:
+                img: PySpin image, which has to be released by the caller
+                info: ChunkInfo of the image
+        '''
+        nincomplete = 0
+        nstale = 0
+        while True:
+            try:
+                if self.software_trigger:
+                    self._cam.TriggerSoftware.Execute()
 
-        if ((H + Ho) > Hmax) or ((W + Wo) > Wmax):
-            raise ValueError('ROI configuration is wrong')
+                img = self._cam.GetNextImage(self.waittime)
+            except PySpin.SpinnakerException as err:
+                raise CameraError('Could not get image: %s'%err) from err
 
-        # Set ROI dimensions first
-        if self._cam.Width.GetAccessMode() == PySpin.RW:
-            self._cam.Width.SetValue(W)
-        else:
-            print('Cannot set width of ROI')
+            if img.IsIncomplete():
+                status = img.GetImageStatus()
+                img.Release()
 
-        if self._cam.Height.GetAccessMode() == PySpin.RW:
-            self._cam.Height.SetValue(H)
-        else:
-            print('Cannot set height of ROI')
+                nincomplete += 1
+                if nincomplete == 3:
+                    raise CameraError('Image incomplete with status %d'%status)
+                continue
 
-        # Then set offset
-        if (Ho < 0) or (Wo < 0):
-            Ho = 4 * ((Hmax - H)//8)
-            Wo = 4 * ((Wmax - W)//8)
+            info = self._image_info(img)
+            if after is not None and info.timestamp < after:
+                img.Release()
 
-        if self._cam.OffsetX.GetAccessMode() == PySpin.RW:
-            self._cam.OffsetX.SetValue(Wo)
-        else:
-            print('Cannot set width offset')
+                nstale += 1
+                if nstale == 100:
+                    raise CameraError('No image exposed after %.6fs'%after)
+                continue
 
-        if self._cam.OffsetY.GetAccessMode() == PySpin.RW:
-            self._cam.OffsetY.SetValue(Ho)
-        else:
-            print('Cannot set height offset')
+            return img, info
 
-        # Now we can restart acquisition
-        self._cam.BeginAcquisition()
-            
-        
-    def capture(self, navg=1):
+    def _image_view(self, img):
+        '''
+            Get a numpy view of an image, converted to RGB if required. The
+            view is only valid till the image is released.
+        '''
+        if self.isrgb and not self.israw and self.demosaic_workers == 0:
+            # Keep the converted image alive while its view is in use
+            img = img.Convert(PySpin.PixelFormat_RGB8, PySpin.HQ_LINEAR)
+            self._converted = img
+
+        return img.GetNDArray()
+
+    def capture(self, navg=1, accumulator=None, out=None, after=None,
+                info=None):
         '''
             Capture and return an image
+
+            Inputs:
+                navg: Number of images to average
+                accumulator: Optional utils.FrameAccumulator to average
+                    with. Default is an integer sum.
+                out: Optional array to copy a single image (navg=1) into,
+                    to avoid allocating a new one
+                after: Optional camera time in seconds, from camera_time.
+                    Images with an earlier timestamp are stale and skipped,
+                    such as images exposed before a new pattern was shown.
+                info: Optional list, to which the ChunkInfo of every image
+                    used is appended. The ChunkInfo of the last image is
+                    also kept in self.frame_info.
+
+            Outputs:
+                img: Captured image, or average of images if navg > 1
+
+            Raises CameraError if an image could not be captured.
         '''
-        imgcap = 0
-        for idx in range(navg):
+        if self.stream is not None:
+            raise RuntimeError('Camera is streaming, get images from the '
+                               'stream instead')
+
+        # Copy a single image straight out of the driver's buffer
+        if navg == 1:
+            img, self.frame_info = self._next_image(after)
+            if info is not None:
+                info.append(self.frame_info)
             try:
-                if self.software_trigger:
-                    self._cam.TriggerSoftware.Execute()
-                    
-                img = self._cam.GetNextImage()
-                H = img.GetHeight()
-                W = img.GetWidth()
-
-                # Convert to RGB if required
-                if self.isrgb:
-                    if self.israw:                       
-                        imgdata = img.GetData().reshape(H, W)
-                    else:
-                        imrgb = img.Convert(PySpin.PixelFormat_RGB8,
-                                            PySpin.HQ_LINEAR)
-                        imgdata = imrgb.GetData().reshape(H, W, -1)
+                view = self._image_view(img)
+                if self.demosaic_workers > 0:
+                    out = self._demosaic(view, out)
+                elif out is None:
+                    out = view.copy()
                 else:
-                    imgdata = img.GetData().reshape(H, W)
+                    np.copyto(out, view)
+            finally:
+                img.Release()
 
-                if navg == 1:
-                    img.Release()
-                    return imgdata
-                else:
-                    imgcap += imgdata.astype(np.float32)
+            return out
 
+        if accumulator is None:
+            accumulator = self._accum
+        accumulator.reset()
+
+        # Average in place, releasing every image as soon as it is added
+        for idx in range(navg):
+            img, self.frame_info = self._next_image(after)
+            if info is not None:
+                info.append(self.frame_info)
+            try:
+                accumulator.add(self._image_view(img))
+            finally:
                 img.Release()
-            except:
-                pdb.set_trace()
-                print('Not sure what happened, but shutting down system')
-                self.close()
 
-                raise SystemError('Camera malfunctioned')
+        # Bilinear demosaicing is linear, so the raw average is demosaiced
+        # once instead of every image
+        if self.demosaic_workers > 0:
+            return utils.demosaic_bilinear(accumulator.mean())
+
+        return accumulator.mean()
 
-        return imgcap/navg
+    def _demosaic(self, raw, out=None):
+        '''
+            Demosaic a raw uint8 image with a reused scratch buffer.
+        '''
+        shape = (4*raw.shape[0] + 2, raw.shape[1] + 2)
+        if self._demosaic_scratch is None or \
+                self._demosaic_scratch.shape != shape:
+            self._demosaic_scratch = np.zeros(shape, dtype=np.uint16)
+
+        return utils.demosaic_bilinear(raw, out, self._demosaic_scratch)
 
     def close(self):
         '''
             Close the camera and release the system
         '''
+        self.stop_stream()
+
         # Reset trigger
         if self._cam.TriggerMode.GetAccessMode() != PySpin.RW:
             raise AttributeError('Unable to disable trigger')
@@ -243,6 +243,73 @@ def loadp(filename):
 
     return data
 
+def _stamps_filename(filename):
+    '''
+        Name of the file with per-frame stamps of a recording.
+    '''
+    return os.path.splitext(filename)[0] + '_stamps.npy'
+
+def create_recording(filename, nframes, shape, dtype=np.uint16):
+    '''
+        Preallocate a recording on disk as a memory-mapped .npy file, which
+        is raw frame data behind a small header.
+
+        Inputs:
+            filename: Name of file to save, usually with .npy extension
+            nframes: Number of frames
+            shape: Shape of a single frame
+            dtype: Data type of frames. Default is uint16
+
+        Outputs:
+            frames: nframes x shape memmap to write frames into
+    '''
+    return np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                     shape=(nframes,) + tuple(shape))
+
+def save_recording_stamps(filename, framestamps, timestamps):
+    '''
+        Save per-frame stamps of a recording next to the frames.
+
+        Inputs:
+            filename: Name of the recording
+            framestamps: Hardware frame counters of frames
+            timestamps: Timestamps of frames in seconds
+
+        Outputs:
+            None
+    '''
+    stamps = np.zeros(len(framestamps), dtype=[('framestamp', np.int64),
+                                               ('timestamp', np.float64)])
+    stamps['framestamp'] = framestamps
+    stamps['timestamp'] = timestamps
+
+    np.save(_stamps_filename(filename), stamps)
+
+def load_recording(filename, mode='r'):
+    '''
+        Load a recording without reading it into memory.
+
+        Inputs:
+            filename: Name of the recording
+            mode: Memory map mode. 'r' is read only, 'r+' allows writing
+                and 'c' is copy on write. Default is 'r'
+
+        Outputs:
+            frames: nframes x H x W memmap of frames. Slices are views, so
+                frames are read from disk only when used.
+            stamps: Structured array with 'framestamp' and 'timestamp' of
+                each frame, or None if they were not saved
+    '''
+    frames = np.load(filename, mmap_mode=mode)
+
+    stamps_filename = _stamps_filename(filename)
+    if os.path.exists(stamps_filename):
+        stamps = np.load(stamps_filename)
+    else:
+        stamps = None
+
+    return frames, stamps
+
 def display_time(total_time):
     '''
         Tiny wrapper to print time in an appropriate way.
@@ -319,6 +386,96 @@ def embed(im, embedsize):
 
     return imembed
 
+def demosaic_bilinear(raw, out=None, scratch=None):
+    '''
+        Bilinear demosaicing of an RGGB Bayer image, such as BayerRG8, into
+        a preallocated RGB image. Neighbour sums are computed over the full
+        frame in place in the scratch buffer, which keeps every array
+        operation contiguous and allocates no temporaries, and are then
+        written to the four Bayer sites.
+
+        Inputs:
+            raw: H x W Bayer image with red at (0, 0). Integer or float
+            out: Optional H x W x 3 output image. Default is an array of the
+                same data type as raw (float32 for float raw)
+            scratch: Optional (4H + 2) x (W + 2) buffer, of uint16 for 8
+                bit, uint32 for 16 bit or float32 for float raw images.
+                Holds the padded image and three neighbour sums. Reuse one
+                across calls to avoid allocations.
+
+        Outputs:
+            out: H x W x 3 RGB image
+    '''
+    H, W = raw.shape
+    isfloat = np.issubdtype(raw.dtype, np.floating)
+
+    if isfloat:
+        work_dtype = np.float32
+    elif raw.dtype.itemsize == 1:
+        work_dtype = np.uint16
+    else:
+        work_dtype = np.uint32
+
+    if out is None:
+        out = np.zeros((H, W, 3), dtype=np.float32 if isfloat else raw.dtype)
+    if scratch is None:
+        scratch = np.zeros((4*H + 2, W + 2), dtype=work_dtype)
+
+    pad = scratch[:H+2]
+    vert = scratch[H+2:2*H+2]               # Up + down, one column wider
+    horiz = scratch[2*H+2:3*H+2, :W]        # Left + right
+    quad = scratch[3*H+2:4*H+2, :W]         # Cross or diagonal
+
+    # Mirror the border, which keeps the Bayer pattern intact at the edges
+    pad[1:-1, 1:-1] = raw
+    pad[0, 1:-1] = raw[1, :]
+    pad[-1, 1:-1] = raw[-2, :]
+    pad[:, 0] = pad[:, 2]
+    pad[:, -1] = pad[:, -3]
+
+    def mean(acc, count):
+        # Rounded mean of a sum of count neighbours, in place
+        if isfloat:
+            np.multiply(acc, 1.0/count, out=acc)
+        else:
+            np.add(acc, count//2, out=acc)
+            np.right_shift(acc, count//2, out=acc)
+
+    def put(channel, dy, dx, values):
+        np.copyto(out[dy::2, dx::2, channel], values[dy::2, dx::2],
+                  casting='unsafe')
+
+    np.add(pad[:-2], pad[2:], out=vert)
+    np.add(pad[1:-1, :-2], pad[1:-1, 2:], out=horiz)
+
+    # Raw values at their own sites
+    for dy, dx, channel in [(0, 0, 0), (0, 1, 1), (1, 0, 1), (1, 1, 2)]:
+        put(channel, dy, dx, pad[1:-1, 1:-1])
+
+    # Red and blue sites: green from the cross, the other color from the
+    # diagonal
+    np.add(vert[:, 1:-1], horiz, out=quad)
+    mean(quad, 4)
+    put(1, 0, 0, quad)
+    put(1, 1, 1, quad)
+
+    np.add(vert[:, :-2], vert[:, 2:], out=quad)
+    mean(quad, 4)
+    put(2, 0, 0, quad)
+    put(0, 1, 1, quad)
+
+    # Green sites: red and blue from horizontal and vertical neighbours,
+    # depending on the row
+    mean(horiz, 2)
+    put(0, 0, 1, horiz)
+    put(2, 1, 0, horiz)
+
+    mean(vert, 2)
+    put(2, 0, 1, vert[:, 1:-1])
+    put(0, 1, 0, vert[:, 1:-1])
+
+    return out
+
 def deconvwnr1(sig, kernel, wconst=1e-2):
     '''
         Deconvolve a 1D signal using Wiener deconvolution
@@ -468,6 +625,161 @@ class UnitScaler(object):
     def transform(self, x):
         return x
 
+class FrameAccumulator(object):
+    '''
+        Accumulate camera frames in place for multi-frame averaging. Buffers
+        are allocated on the first frame and reused till the shape changes,
+        so adding a frame does not allocate memory.
+    '''
+    def __init__(self, mode='sum', dtype=np.float64, nframes=None, nsigma=3,
+                 shape=None):
+        '''
+            Create an accumulator.
+
+            Inputs:
+                mode: 'sum' (default) sums frames into a buffer of type
+                    dtype. 'welford' keeps a running per-pixel mean and
+                    variance. 'sigmaclip' keeps all frames and averages
+                    them after rejecting per-pixel outliers.
+                dtype: Type of the sum buffer for 'sum' mode. Use np.uint32
+                    for integer frames and np.float64 otherwise.
+                nframes: Maximum number of frames for 'sigmaclip' mode
+                nsigma: Pixels farther than nsigma standard deviations from
+                    the mean are rejected in 'sigmaclip' mode. Default is 3
+                shape: Shape of frames. Default is shape of the first frame
+
+            Outputs:
+                None
+        '''
+        if mode not in ['sum', 'welford', 'sigmaclip']:
+            raise ValueError('Accumulator mode %s not supported'%mode)
+
+        if mode == 'sigmaclip' and nframes is None:
+            raise ValueError('sigmaclip mode requires nframes')
+
+        self.mode = mode
+        self.dtype = dtype
+        self.nframes = nframes
+        self.nsigma = nsigma
+        self.shape = None
+        self.count = 0
+
+        if shape is not None:
+            self._allocate(tuple(shape))
+
+    def _allocate(self, shape):
+        '''
+            Allocate buffers for frames of a given shape.
+        '''
+        self.shape = shape
+
+        if self.mode == 'sum':
+            self._sum = np.zeros(shape, dtype=self.dtype)
+        elif self.mode == 'welford':
+            self._mean = np.zeros(shape)
+            self._m2 = np.zeros(shape)
+            self._delta = np.zeros(shape)
+            self._delta2 = np.zeros(shape)
+        else:
+            self._stack = np.zeros((self.nframes,) + shape, dtype=np.float32)
+
+    def reset(self):
+        '''
+            Clear accumulated frames, keeping the buffers.
+        '''
+        self.count = 0
+
+    def add(self, frame):
+        '''
+            Add a frame.
+
+            Inputs:
+                frame: Frame of the same shape as previous frames
+
+            Outputs:
+                None
+        '''
+        if frame.shape != self.shape:
+            self._allocate(frame.shape)
+            self.count = 0
+
+        self.count += 1
+
+        if self.mode == 'sum':
+            if self.count == 1:
+                np.copyto(self._sum, frame, casting='unsafe')
+            else:
+                np.add(self._sum, frame, out=self._sum, casting='unsafe')
+        elif self.mode == 'welford':
+            np.subtract(frame, self._mean, out=self._delta)
+            np.multiply(self._delta, 1.0/self.count, out=self._delta2)
+            self._mean += self._delta2
+
+            np.subtract(frame, self._mean, out=self._delta2)
+            np.multiply(self._delta, self._delta2, out=self._delta)
+
+            if self.count == 1:
+                self._m2[...] = 0
+            self._m2 += self._delta
+        else:
+            if self.count > self.nframes:
+                raise ValueError('More than %d frames added'%self.nframes)
+            self._stack[self.count-1, ...] = frame
+
+    def _clipped(self):
+        '''
+            Get frames as a masked array with outliers masked.
+        '''
+        frames = self._stack[:self.count]
+        mean = frames.mean(0)
+        std = frames.std(0)
+
+        outliers = abs(frames - mean) > self.nsigma*std
+
+        return np.ma.masked_array(frames, outliers)
+
+    def mean(self, out=None):
+        '''
+            Get the mean of accumulated frames.
+
+            Inputs:
+                out: Optional float32 array to write the mean to
+
+            Outputs:
+                mean: Mean frame (float32)
+        '''
+        if self.count == 0:
+            raise ValueError('No frames accumulated')
+
+        if out is None:
+            out = np.zeros(self.shape, dtype=np.float32)
+
+        if self.mode == 'sum':
+            np.divide(self._sum, self.count, out=out, casting='unsafe')
+        elif self.mode == 'welford':
+            np.copyto(out, self._mean, casting='unsafe')
+        else:
+            np.copyto(out, self._clipped().mean(0).filled(0),
+                      casting='unsafe')
+
+        return out
+
+    def var(self):
+        '''
+            Get the per-pixel variance of accumulated frames. Not available
+            in 'sum' mode.
+        '''
+        if self.mode == 'sum':
+            raise ValueError('Variance is not tracked in sum mode')
+
+        if self.count < 2:
+            raise ValueError('Need at least two frames for variance')
+
+        if self.mode == 'welford':
+            return self._m2/(self.count - 1)
+
+        return self._clipped().var(0, ddof=1).filled(0)
+
 if __name__ == '__main__':
     foldername = '../experiments/spectra/lab2'
     lmb1 = 600